@@ -0,0 +1,181 @@
+""" Benchmark of the download engines of download tile_bbox.
+
+Serves tiles from a local HTTP server that waits before every response, like
+a distant API, and downloads them with the threads and the async engine at
+several numbers of workers. Each run is a process of its own, so the peak
+RSS it reports is that of the run alone.
+
+Run it from the repository root, the async engine requires aiohttp:
+
+    python benchmarks/engines.py
+    python benchmarks/engines.py --tiles 2000 --latency 0.1 --workers 64 256
+"""
+
+import argparse
+import http.server
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from deepmap_cli.async_engine import AsyncDownloadScheduler
+from deepmap_cli.cli_requests import _download_tile_by_url
+from deepmap_cli.scheduler import DownloadScheduler
+from deepmap_cli.utils import peak_rss
+from deepmap_cli.writer import TileWriter
+
+
+def serve(size, latency):
+    """ Starts the tile server on a free port of localhost.
+
+    Args:
+        size: Size in bytes of every tile.
+        latency: Seconds the server waits before each response.
+    Returns:
+        The base url of the server.
+    """
+    body = os.urandom(size)
+
+    class TileHandler(http.server.BaseHTTPRequestHandler):
+        """ Answers every GET with a tile after the latency. """
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            try:
+                self.wfile.write(body)
+            except ConnectionError:
+                pass
+
+        def log_message(self, *args):  # pylint: disable=arguments-differ
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), TileHandler)
+    server.daemon_threads = True
+    server.request_queue_size = 1024
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+
+def run(engine, workers, url, tiles):
+    """ Downloads the tiles with one engine, the way tile_bbox does.
+
+    Args:
+        engine: threads or async.
+        workers: Number of downloads in flight.
+        url: The base url of the tile server.
+        tiles: Number of tiles to download.
+    Returns:
+        A dict of the bytes downloaded, the seconds it took and the peak RSS.
+    """
+    dest_folder = tempfile.mkdtemp(prefix='deepmap_benchmark.')
+    writer = TileWriter()
+    lock = threading.Lock()
+    written = [0]
+
+    def finished(job, dest, size):
+        with lock:
+            written[0] += size
+        os.remove(dest)
+
+    def tile_url(job):
+        return '{}/tile?x={}&y=0&z=16'.format(url, job)
+
+    def tile_dest(job):
+        return '{}/GeoJsonTile_benchmark_{}_0_16.tar.gz'.format(dest_folder, job)
+
+    if engine == 'async':
+        scheduler = AsyncDownloadScheduler(
+            lambda job: (tile_url(job), tile_dest(job)),
+            writer,
+            finished,
+            workers=workers)
+    else:
+
+        def download(job):
+            dest, size = _download_tile_by_url(tile_url(job),
+                                               dest_folder,
+                                               'GeoJsonTile',
+                                               'benchmark',
+                                               job,
+                                               0,
+                                               16,
+                                               headers={},
+                                               writer=writer)
+            if dest is not None:
+                finished(job, dest, size)
+            return dest
+
+        scheduler = DownloadScheduler(download, workers=workers)
+
+    # The downloads print every destination, which is not measured.
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    start = time.time()
+    try:
+        scheduler.start()
+        for job in range(tiles):
+            scheduler.put(job)
+        scheduler.join()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    seconds = time.time() - start
+    os.rmdir(dest_folder)
+    return {'bytes': written[0], 'seconds': seconds, 'peak_rss': peak_rss()}
+
+
+def main():
+    """ Runs every engine and number of workers and prints a table. """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--tiles', type=int, default=1000,
+                        help='Number of tiles per run. Defaults to 1000.')
+    parser.add_argument('--size', type=int, default=120 * 1000,
+                        help='Size in bytes of a tile. Defaults to 120 KB.')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Seconds before each response. Defaults to 0.05.')
+    parser.add_argument('--workers', type=int, nargs='+', default=[16, 200],
+                        help='Numbers of workers to run. Defaults to 16 200.')
+    parser.add_argument('--engines', nargs='+', default=['threads', 'async'],
+                        choices=['threads', 'async'],
+                        help='Engines to run. Defaults to both.')
+    parser.add_argument('--run', nargs=3, metavar=('ENGINE', 'WORKERS', 'URL'),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        engine, workers, url = args.run
+        print(json.dumps(run(engine, int(workers), url, args.tiles)))
+        return
+
+    url = serve(args.size, args.latency)
+    print('{} tiles of {} bytes, {} s latency'.format(args.tiles, args.size,
+                                                      args.latency))
+    print('{:<8} {:>7} {:>9} {:>14}'.format('engine', 'workers', 'MB/s',
+                                            'peak RSS MiB'))
+    for engine in args.engines:
+        for workers in args.workers:
+            command = [
+                sys.executable, __file__, '--tiles',
+                str(args.tiles), '--run', engine,
+                str(workers), url
+            ]
+            output = subprocess.run(command,
+                                    check=True,
+                                    stdout=subprocess.PIPE).stdout
+            result = json.loads(output.decode().strip().splitlines()[-1])
+            print('{:<8} {:>7} {:>9.1f} {:>14.1f}'.format(
+                engine, workers, result['bytes'] / result['seconds'] / 1e6,
+                (result['peak_rss'] or 0) / 2**20))
+
+
+if __name__ == '__main__':
+    main()
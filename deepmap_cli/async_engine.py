@@ -0,0 +1,235 @@
+""" Deepmap CLI asyncio download engine. """
+
+import asyncio
+import itertools
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from deepmap_cli.constants import ASYNC_CHUNK_SIZE
+from deepmap_cli.trace import tracer
+from deepmap_cli.utils import print_formatted_json
+
+
+class AsyncDownloadScheduler(object):
+    """ Runs download jobs as coroutines on a single event loop thread.
+
+    A drop-in for DownloadScheduler with the same start, put and join
+    methods, for when hundreds of downloads are in flight: every connection
+    is a coroutine of one thread instead of a thread of its own.
+
+    The file writes run on a small thread pool, so disk I/O never blocks the
+    event loop. Each download waits for the write of a chunk before reading
+    the next one, so a disk slower than the network pauses the downloads
+    instead of buffering their responses in memory.
+
+    Requires aiohttp, e.g. 'pip install .[async]'.
+    """
+
+    def __init__(self,
+                 request_for,
+                 writer,
+                 finished,
+                 failed=None,
+                 headers=None,
+                 workers=64,
+                 max_pending=1024,
+                 priority=None,
+                 write_threads=4,
+                 chunk_size=ASYNC_CHUNK_SIZE):
+        """ Creates a scheduler.
+
+        Args:
+            request_for: Function returning the (url, dest) of a job. It is
+                called on a write thread, so it may block, e.g. on a journal.
+            writer: The TileWriter the downloads are written with.
+            finished: Function called with each job, its destination and its
+                size in bytes once it is written. It is called on a write
+                thread.
+            failed: Optional: Function called with each job whose download
+                failed, on a write thread.
+            headers: Optional: Headers of every request.
+            workers: Number of downloads in flight at once.
+            max_pending: Number of jobs that can wait in the queue, 0 for no
+                limit.
+            priority: Optional: Function returning the priority of a job.
+            write_threads: Number of threads writing files.
+            chunk_size: Largest number of bytes read from a response at once,
+                which each download in flight may hold in memory.
+        """
+        try:
+            import aiohttp  # pylint: disable=unused-import,import-outside-toplevel
+        except ImportError:
+            sys.exit("--engine async requires aiohttp. "
+                     "Install it with 'pip install aiohttp'.")
+        self._request_for = request_for
+        self._writer = writer
+        self._finished = finished
+        self._failed = failed
+        self._headers = headers or {}
+        self._workers = max(1, workers)
+        self._max_pending = max_pending
+        self._priority = priority
+        self._chunk_size = chunk_size
+        self._sequence = itertools.count()
+        self._executor = ThreadPoolExecutor(max_workers=write_threads)
+        self._loop = None
+        self._queue = None
+        self._thread = None
+        self._ready = threading.Event()
+        self._error = None
+        self.completed = 0
+        self.failed = 0
+
+    def start(self):
+        """ Starts the event loop thread. """
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        if self._error is not None:
+            raise self._error
+
+    def put(self, job):
+        """ Queues a job, blocking while the queue is full.
+
+        Args:
+            job: The job passed on to request_for and finished.
+        """
+        priority = self._priority(job) if self._priority else 0
+        # The sequence number keeps equal priorities in queue order.
+        asyncio.run_coroutine_threadsafe(
+            self._queue.put((priority, next(self._sequence), job)),
+            self._loop).result()
+
+    def join(self):
+        """ Waits for every queued job to finish and stops the event loop. """
+        for _ in range(self._workers):
+            asyncio.run_coroutine_threadsafe(
+                self._queue.put((float('inf'), next(self._sequence), None)),
+                self._loop).result()
+        self._thread.join()
+        self._executor.shutdown()
+
+    def _run(self):
+        """ Event loop thread, runs the downloads until they are all done. """
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._loop.run_until_complete(self._main())
+        except Exception as error:  # pylint: disable=broad-except
+            self._error = error
+        finally:
+            self._ready.set()
+            self._loop.close()
+
+    async def _main(self):
+        """ Opens the connection pool and runs the download coroutines. """
+        import aiohttp  # pylint: disable=import-outside-toplevel
+
+        self._queue = asyncio.PriorityQueue(maxsize=self._max_pending)
+        connector = aiohttp.TCPConnector(limit=self._workers)
+        timeout = aiohttp.ClientTimeout(total=None)
+        # Like the raw responses the threads write, bodies are saved as sent.
+        async with aiohttp.ClientSession(connector=connector,
+                                         timeout=timeout,
+                                         headers=self._headers,
+                                         auto_decompress=False) as session:
+            self._ready.set()
+            await asyncio.gather(
+                *(self._work(session) for _ in range(self._workers)))
+
+    async def _work(self, session):
+        """ Download coroutine, downloads jobs until it receives None. """
+        while True:
+            job = (await self._queue.get())[2]
+            if job is None:
+                return
+            try:
+                result = await self._download(session, job)
+            except Exception as error:  # pylint: disable=broad-except
+                print("Download of {} failed: {}".format(job, error),
+                      file=sys.stderr)
+                result = None
+            if result is None:
+                self.failed += 1
+                if self._failed is not None:
+                    await asyncio.get_running_loop().run_in_executor(
+                        self._executor, self._failed, job)
+            else:
+                self.completed += 1
+
+    async def _download(self, session, job):
+        """ Downloads a job into its destination.
+
+        Args:
+            session: The aiohttp session.
+            job: The job to download.
+        Returns:
+            The destination of the job, or None if the request failed.
+        """
+        loop = asyncio.get_running_loop()
+        url, dest = await loop.run_in_executor(self._executor,
+                                               self._request_for, job)
+        start = time.time_ns()
+        attributes = {'http.request.method': 'GET', 'url.full': url}
+        error = None
+        try:
+            async with session.get(url) as response:
+                attributes['http.response.status_code'] = response.status
+                if response.status != 200:
+                    _print_error(await response.read())
+                    return None
+                length = response.headers.get('Content-Length')
+                length = int(length) if length and length.isdigit() else None
+                attributes['http.response.content_length'] = length
+                print("write to dest {}".format(dest))
+                partial = await loop.run_in_executor(self._executor,
+                                                     self._writer.begin, dest,
+                                                     length)
+                try:
+                    async for chunk in response.content.iter_chunked(
+                            self._chunk_size):
+                        await loop.run_in_executor(self._executor,
+                                                   partial.write, chunk)
+                except BaseException:
+                    partial.abort()
+                    raise
+            size = await loop.run_in_executor(self._executor, self._finish,
+                                              job, partial)
+            attributes['file.path'] = dest
+            attributes['file.size'] = size
+            return dest
+        except Exception as exception:
+            error = exception
+            raise
+        finally:
+            tracer.record('GET',
+                          start,
+                          time.time_ns(),
+                          kind='CLIENT',
+                          error=error,
+                          **attributes)
+
+    def _finish(self, job, partial):
+        """ Completes the file of a job on a write thread.
+
+        Returns:
+            The size of the file.
+        """
+        size = self._writer.finish(partial)
+        self._finished(job, partial.dest, size)
+        return size
+
+
+def _print_error(body):
+    """ Prints the body of a failed response to stderr.
+
+    Args:
+        body: The bytes of the response body.
+    """
+    try:
+        print_formatted_json(json.loads(body.decode()), fd=sys.stderr)
+    except ValueError:
+        print(body.decode(errors='replace'), file=sys.stderr)
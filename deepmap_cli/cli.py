@@ -5,12 +5,53 @@ import argparse
 import sys
 import os
 
-from deepmap_cli.constants import USER_CONFIG_PATH
+from deepmap_cli.constants import USER_CONFIG_PATH, DEFAULT_BUFFER_SIZE
 from deepmap_cli.cli_requests import make_request
+from deepmap_cli.trace import tracer
+from deepmap_cli.completion import MAPS, FORMATS, API_TOKENS, VEHICLE_TOKENS,\
+    DIRECTORIES
 
 
 def init_cli():
     """ Initializes the CLI. """
+    parser = build_parser()
+    args = parser.parse_args(sys.argv[1:])
+
+    url_passed_in = False
+    # Cast args to namespace for membership testing
+    if 'server_url' in vars(args).keys():
+        # Check if args.server_url is not None
+        if args.server_url:
+            server_url = args.server_url
+            url_passed_in = True
+
+    if not url_passed_in:
+        # Retrieve url if a previous url is stored.
+        if os.path.isfile(USER_CONFIG_PATH):
+            with open(USER_CONFIG_PATH, mode='r') as config_file:
+                server_url = config_file.readline()
+        # Default url.
+        else:
+            server_url = 'https://api.deepmap.com'
+
+    # Call the correct command if valid
+    if args.command:
+        if args.trace:
+            tracer.start(args.trace)
+        try:
+            make_request(args, server_url)
+        finally:
+            tracer.stop()
+    else:
+        parser.print_help()
+
+
+def build_parser():
+    """ Builds the parser of the CLI, also the source of its shell completion.
+
+    Returns:
+        The argparse parser.
+    """
     parser = argparse.ArgumentParser(
         prog='deepmap',
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -22,10 +63,14 @@ def init_cli():
         "    download       Downloads the specified files and pipes output to stdout.\n"
         "    list           List valid users, maps, tokens, tiles_diff, or tiles.\n"
         "    search         Search valid tiles.\n"
+        "    query local    Find downloaded tiles covering a position or bounding box.\n"
+        "    gc             Remove deduplicated file content that is no longer used.\n"
+        "    jobs           List, resume or cancel bulk tile downloads.\n"
         "    invite         Invite a user to join your account.\n"
         "    get user       Get a description of your account.\n"
         "    edit user      Edit the email or admin permissions of a user.\n"
         "    delete         Delete a user or token from your account.\n"
+        "    completion     Print a bash or zsh completion script for deepmap.\n"
         "\n"
         "Use the -h flag for help information.\n"
         "For example, for general help, run \"deepmap -h\"\n"
@@ -36,6 +81,10 @@ def init_cli():
         "as long as the abbreviation is unique e.g. --u or --user or --usern for\n"
         "--username in the login command.\n"
         "\n")
+    parser.add_argument(
+        '--trace',
+        help='Optional: Append a JSON lines trace of the command, its requests and file writes '
+             'to this file.')
     subparsers = parser.add_subparsers(dest='command')
 
     init_login_parser(subparsers)
@@ -44,35 +93,15 @@ def init_cli():
     init_download_parser(subparsers)
     init_list_parser(subparsers)
     init_search_parser(subparsers)
+    init_query_parser(subparsers)
+    init_gc_parser(subparsers)
+    init_jobs_parser(subparsers)
     init_invite_parser(subparsers)
     init_get_parser(subparsers)
     init_edit_parser(subparsers)
     init_delete_parser(subparsers)
-
-    args = parser.parse_args(sys.argv[1:])
-
-    url_passed_in = False
-    # Cast args to namespace for membership testing
-    if 'server_url' in vars(args).keys():
-        # Check if args.server_url is not None
-        if args.server_url:
-            server_url = args.server_url
-            url_passed_in = True
-
-    if not url_passed_in:
-        # Retrieve url if a previous url is stored.
-        if os.path.isfile(USER_CONFIG_PATH):
-            with open(USER_CONFIG_PATH, mode='r') as config_file:
-                server_url = config_file.readline()
-        # Default url.
-        else:
-            server_url = 'https://api.deepmap.com'
-
-    # Call the correct command if valid
-    if args.command:
-        make_request(args, server_url)
-    else:
-        parser.print_help()
+    init_completion_parser(subparsers)
+    return parser
 
 
 def init_login_parser(subparsers):
@@ -174,30 +203,48 @@ def init_download_parser(subparsers):
         'feature_tile', help='Download a feature tile of a map.')
     download_feature_tile_parser.add_argument(
         'id', help='The id of the feature_tile to download')
+    init_write_args(download_feature_tile_parser)
 
     # Map distribution is target of download.
     download_distribution_parser = download_subparsers.add_parser(
         'distribution', help='Download a map distribution.')
     download_distribution_parser.add_argument(
-        'id', help='The id of the map distribution to download')
+        'id', help='The id of the map distribution to download').completer = MAPS
     download_distribution_parser.add_argument(
-        'dest_folder', help='This is the destination where to save downloaded results.')
+        'dest_folder', help='This is the destination where to save downloaded results.').completer = DIRECTORIES
     download_distribution_parser.add_argument(
         '--format',
         help=
         'Format of the distribution to download. Required if multiple formats are available.'
-    )
+    ).completer = FORMATS
     download_distribution_parser.add_argument(
         '--version',
         help=
         'Optional: Version of the map to download. Otherwise latest version is downloaded.'
     )
+    download_distribution_parser.add_argument(
+        '--update',
+        action='store_true',
+        help='Optional: Update the local tiles in dest_folder to --version by downloading only '
+             'the tiles that changed, instead of the whole distribution. In this mode versions are '
+             'release timestamps in milliseconds.')
+    download_distribution_parser.add_argument(
+        '--update_from',
+        help='Optional: The version of the local copy in dest_folder. Defaults to the version '
+             'recorded by the previous update.')
+    download_distribution_parser.add_argument(
+        '--z', help='Zoom level of the local tiles. Required with --update.')
+    download_distribution_parser.add_argument(
+        '--plan', action='store_true',
+        help='Optional: Print the number of bytes the download would transfer and an estimate '
+             'of its duration, without downloading.')
+    init_write_args(download_distribution_parser)
 
     # Tile is target of download.
     download_tile_parser = download_subparsers.add_parser(
         'tile', help='Download a tile of a map.')
     download_tile_parser.add_argument(
-        'id', help='The id of the map')
+        'id', help='The id of the map').completer = MAPS
     download_tile_parser.add_argument(
         'z', help='Zoom level of the map.')
     download_tile_parser.add_argument(
@@ -210,9 +257,9 @@ def init_download_parser(subparsers):
                   'Our (0, 0) map offset is at the top left of the map.')
     download_tile_parser.add_argument(
         'format', help='The format for the desired tile. This must be a format that is available for this map. '
-                       'The available formats of this map could be found by `deepmap list maps [-h]`.')
+                       'The available formats of this map could be found by `deepmap list maps [-h]`.').completer = FORMATS
     download_tile_parser.add_argument(
-        'dest_folder', help='This is the destination where to save downloaded results.')
+        'dest_folder', help='This is the destination where to save downloaded results.').completer = DIRECTORIES
     download_tile_parser.add_argument(
         '--before', help='Optional: The timestamp in milliseconds. The upper bound of the time range which '
                        'targeted tile should belong to. If the field is set, it will only fetch tiles '
@@ -222,11 +269,13 @@ def init_download_parser(subparsers):
                       'tile should belong to. If the field is set, it will only fetch tiles which version '
                       'is newer than or equal to the given timestamp.')
 
+    init_write_args(download_tile_parser)
+
     # Tiles in bbox are the target of download.
     download_tile_bbox_parser = download_subparsers.add_parser(
-        'tile_bbox', help='Download a tile of a map.')
+        'tile_bbox', help='Download the tiles of maps within a bounding box.')
     download_tile_bbox_parser.add_argument(
-        'id', help='Id of the map.')
+        'id', help='Id of the map, or comma separated ids of several maps.').completer = MAPS
     download_tile_bbox_parser.add_argument(
         'z', help='Zoom level of the map.')
     download_tile_bbox_parser.add_argument(
@@ -238,10 +287,11 @@ def init_download_parser(subparsers):
     download_tile_bbox_parser.add_argument(
         'lng2', help='The second longitude of the bounding box.')
     download_tile_bbox_parser.add_argument(
-        'format', help='The format for the desired tile. This must be a format that is available for this map. '
-                       'The available formats of this map could be found by `deepmap list maps [-h]`.')
+        'format', help='The format for the desired tiles, or comma separated formats. These must be '
+                       'formats that are available for the maps. The available formats of a map '
+                       'could be found by `deepmap list maps [-h]`.').completer = FORMATS
     download_tile_bbox_parser.add_argument(
-        'dest_folder', help='This is the destination where to save downloaded results.')
+        'dest_folder', help='This is the destination where to save downloaded results.').completer = DIRECTORIES
     download_tile_bbox_parser.add_argument(
         '--before', help='Optional: The timestamp in milliseconds. The upper bound of the time range which '
                        'targeted tile should belong to. If the field is set, it will only fetch tiles '
@@ -250,6 +300,78 @@ def init_download_parser(subparsers):
         '--after', help='Optional: The timestamp in milliseconds. The lower bound of the time range which targeted '
                       'tile should belong to. If the field is set, it will only fetch tiles which version '
                       'is newer than or equal to the given timestamp.')
+    download_tile_bbox_parser.add_argument(
+        '--workers', type=int, default=4,
+        help='Optional: Number of tiles downloaded in parallel. Defaults to 4.')
+    download_tile_bbox_parser.add_argument(
+        '--engine', choices=['threads', 'async'], default='threads',
+        help='Optional: threads downloads each tile on a thread of its own, async downloads '
+             'every tile on a single thread with asyncio, which scales to hundreds of --workers. '
+             'async requires aiohttp. Defaults to threads.')
+    download_tile_bbox_parser.add_argument(
+        '--order', choices=['search', 'center', 'route', 'hilbert'], default='search',
+        help='Optional: The order tiles are downloaded in. search keeps the order of the search '
+             'results, center starts closest to --center, route starts closest to --route and '
+             'hilbert follows a Hilbert curve over the tile grid. Downloads start while the search '
+             'runs, with the first of the tiles found so far, and the tiles waiting are held in '
+             'memory. Defaults to search.')
+    download_tile_bbox_parser.add_argument(
+        '--center', type=float, nargs=2, metavar=('LAT', 'LNG'),
+        help='Optional: The position tiles are downloaded around with --order center. '
+             'Defaults to the center of the bounding box.')
+    download_tile_bbox_parser.add_argument(
+        '--route',
+        help='Optional: A file with one "lat,lng" point of a route per line, for --order route.')
+    download_tile_bbox_parser.add_argument(
+        '--plan', action='store_true',
+        help='Optional: Print the number of tiles and bytes the download would transfer, leaving '
+             'out tiles already in dest_folder, and an estimate of its duration, without '
+             'downloading.')
+    download_tile_bbox_parser.add_argument(
+        '--head', action='store_true',
+        help='Optional: With --plan, send a HEAD request for each tile to get its size.')
+    download_tile_bbox_parser.add_argument(
+        '--convert', choices=['pose=npy', 'pose=parquet'],
+        help='Optional: Also convert the downloaded PoseTile csv files into one columnar file '
+             'for the bounding box, a structured numpy array (npy) or a parquet file. '
+             'Requires numpy, and pyarrow for parquet.')
+    download_tile_bbox_parser.add_argument(
+        '--merge',
+        help='Optional: Also merge the features of the downloaded GeoJsonTile archives into this '
+             'file. Features repeated across tiles are written once, which keeps a small digest '
+             'of every feature in memory until the merge ends.')
+    download_tile_bbox_parser.add_argument(
+        '--merge_format', choices=['geojson', 'ndjson'], default='geojson',
+        help='Optional: Write the merged features as a FeatureCollection (geojson) or one '
+             'feature per line (ndjson). Defaults to geojson.')
+    download_tile_bbox_parser.add_argument(
+        '--clip', action='store_true',
+        help='Optional: Clip the merged features to the bounding box.')
+    init_write_args(download_tile_bbox_parser)
+
+
+def init_write_args(parser):
+    """ Adds the args controlling how downloaded files are written.
+
+    Args:
+        parser: The download subcommand parser.
+    """
+    parser.add_argument(
+        '--buffer_size', type=int, default=DEFAULT_BUFFER_SIZE,
+        help='Optional: Size in bytes of the buffer downloaded files are written with. '
+             'Defaults to 1 MiB.')
+    parser.add_argument(
+        '--fsync_batch', type=int, default=0,
+        help='Optional: Fsync downloaded files to disk, this many files at a time. '
+             'Defaults to 0, which does not fsync.')
+    parser.add_argument(
+        '--dedup', action='store_true',
+        help='Optional: Store the content of downloaded files once, in a blob store in '
+             'dest_folder, and hard link the files to it. Identical files share disk space.')
+    parser.add_argument(
+        '--blob_store',
+        help='Optional: The blob store to use instead, implies --dedup. Share one store between '
+             'folders on the same filesystem to deduplicate across them.')
 
 def init_invite_parser(subparsers):
     """ Sets up invite parser args.
@@ -285,7 +407,7 @@ def init_list_parser(subparsers):
     # Feature tiles are targets of list.
     list_feature_tiles_parser = list_subparsers.add_parser(
         'feature_tiles', description='List feature tiles for a map.')
-    list_feature_tiles_parser.add_argument('id', help='Id of the map.')
+    list_feature_tiles_parser.add_argument('id', help='Id of the map.').completer = MAPS
 
     # Users are targets of list.
     list_subparsers.add_parser('users', description='List users.')
@@ -308,12 +430,12 @@ def init_list_parser(subparsers):
     list_tiles_diff_parser = list_subparsers.add_parser(
         'tiles_diff', description='List updated tiles for a map.')
     list_tiles_diff_parser.add_argument(
-        'id', help='Id of the map.')
+        'id', help='Id of the map.').completer = MAPS
     list_tiles_diff_parser.add_argument(
         'z', help='Zoom level of the map.')
     list_tiles_diff_parser.add_argument(
         'format', help='The format for the desired tile. This must be a format that is available for this map. '
-                       'The available formats of this map could be found by `deepmap list maps [-h]`.')
+                       'The available formats of this map could be found by `deepmap list maps [-h]`.').completer = FORMATS
     list_tiles_diff_parser.add_argument(
         '--before', help='Optional: The timestamp in milliseconds. The upper bound of the time range which '
                        'targeted tile should belong to. If the field is set, it will only fetch tiles '
@@ -337,7 +459,7 @@ def init_search_parser(subparsers):
     search_tile_parser = search_subparsers.add_parser(
         'tiles', description='Search tiles for a map.')
     search_tile_parser.add_argument(
-        'id', help='Id of the map.')
+        'id', help='Id of the map.').completer = MAPS
     search_tile_parser.add_argument(
         'z', help='Zoom level of the map.')
     search_tile_parser.add_argument(
@@ -350,7 +472,7 @@ def init_search_parser(subparsers):
         'lng2', help='The second longitude of the web mercator bounding box.')
     search_tile_parser.add_argument(
         'format', help='The format for the desired tile. This must be a format that is available for this map. '
-                       'The available formats of this map could be found by `deepmap list maps [-h]`.')
+                       'The available formats of this map could be found by `deepmap list maps [-h]`.').completer = FORMATS
     search_tile_parser.add_argument(
         '--before', help='Optional: The timestamp in milliseconds. The upper bound of the time range which '
                        'targeted tile should belong to. If the field is set, it will only fetch tiles '
@@ -360,6 +482,76 @@ def init_search_parser(subparsers):
                       'tile should belong to. If the field is set, it will only fetch tiles which version '
                       'is newer than or equal to the given timestamp.')
 
+def init_query_parser(subparsers):
+    """ Sets up query parser args.
+
+    Args:
+        subparsers: subparsers object for the main parser.
+    """
+    query_parser = subparsers.add_parser(
+        'query', description='Query downloaded data without a request to the api.')
+    query_subparsers = query_parser.add_subparsers(dest='query_target')
+
+    # Downloaded tiles are the target of query.
+    query_local_parser = query_subparsers.add_parser(
+        'local', description='Find the downloaded tiles covering a position, or intersecting '
+                             'a bounding box if --lat2 and --lng2 are given.')
+    query_local_parser.add_argument(
+        'dest_folder', help='The folder the tiles were downloaded into.').completer = DIRECTORIES
+    query_local_parser.add_argument(
+        'lat', type=float, help='The latitude of the position.')
+    query_local_parser.add_argument(
+        'lng', type=float, help='The longitude of the position.')
+    query_local_parser.add_argument(
+        '--lat2', type=float, help='Optional: The second latitude of a bounding box.')
+    query_local_parser.add_argument(
+        '--lng2', type=float, help='Optional: The second longitude of a bounding box.')
+    query_local_parser.add_argument(
+        '--id', help='Optional: Only find tiles of this map.').completer = MAPS
+    query_local_parser.add_argument(
+        '--format', help='Optional: Only find tiles of this format.').completer = FORMATS
+    query_local_parser.add_argument(
+        '--rebuild', action='store_true',
+        help='Optional: Rebuild the index from the tile file names first, e.g. for tiles '
+             'downloaded before the index existed.')
+
+def init_gc_parser(subparsers):
+    """ Sets up gc parser args.
+
+    Args:
+        subparsers: subparsers object for the main parser.
+    """
+    gc_parser = subparsers.add_parser(
+        'gc', description='Remove the content of a blob store that no downloaded file links to '
+                          'anymore.')
+    gc_parser.add_argument(
+        'blob_store', help='The blob store, or the dest_folder of downloads made with --dedup.').completer = DIRECTORIES
+
+
+def init_jobs_parser(subparsers):
+    """ Sets up jobs parser args.
+
+    Args:
+        subparsers: subparsers object for the main parser.
+    """
+    jobs_parser = subparsers.add_parser(
+        'jobs', description='Manage the bulk tile downloads of "download tile_bbox".')
+    jobs_subparsers = jobs_parser.add_subparsers(dest='jobs_target')
+
+    jobs_subparsers.add_parser(
+        'list', description='List the download jobs and how many of their tiles are planned, '
+                            'in flight and done.')
+
+    jobs_resume_parser = jobs_subparsers.add_parser(
+        'resume', description='Continue an interrupted or incomplete job where it stopped, '
+                              'without searching again.')
+    jobs_resume_parser.add_argument('id', type=int, help='The id of the job.')
+
+    jobs_cancel_parser = jobs_subparsers.add_parser(
+        'cancel', description='Drop a job that is not running, so it can no longer be resumed.')
+    jobs_cancel_parser.add_argument('id', type=int, help='The id of the job.')
+
+
 def init_get_parser(subparsers):
     """ Sets up get parser args.
 
@@ -402,13 +594,13 @@ def init_delete_parser(subparsers):
     # API token is target of delete.
     delete_api_token_parser = delete_token_subparsers.add_parser(
         'api', description='Delete an issued API access token.')
-    delete_api_token_parser.add_argument('id', help='The id of the API token.')
+    delete_api_token_parser.add_argument('id', help='The id of the API token.').completer = API_TOKENS
 
     # Vehicle token is target of delete.
     delete_vehicle_token_parser = delete_token_subparsers.add_parser(
         'vehicle', description='Delete an issued vehicle access token.')
     delete_vehicle_token_parser.add_argument(
-        'id', help='The id of the vehicle token.')
+        'id', help='The id of the vehicle token.').completer = VEHICLE_TOKENS
 
 
 def init_edit_parser(subparsers):
@@ -433,5 +625,26 @@ def init_edit_parser(subparsers):
         choices=['True', 'False'])
 
 
+
+def init_completion_parser(subparsers):
+    """ Sets up completion parser args.
+
+    Args:
+        subparsers: subparsers object for the main parser.
+    """
+    completion_parser = subparsers.add_parser(
+        'completion', description='Print a completion script for deepmap. Load it with '
+                                  '\'eval "$(deepmap completion)"\', e.g. in ~/.bashrc. Map ids, '
+                                  'formats and token ids complete from a local cache, which is '
+                                  'refreshed in the background.')
+    completion_parser.add_argument(
+        '--shell', choices=['bash', 'zsh'], default='bash',
+        help='Optional: The shell to complete in. Defaults to bash.')
+    completion_parser.add_argument(
+        '--refresh', action='store_true',
+        help='Optional: Refresh the cached map ids, formats and token ids instead of printing '
+             'the script.')
+
+
 if __name__ == '__main__':
     init_cli()
@@ -3,15 +3,31 @@
 import os
 import sys
 import json
+import argparse
 import getpass
 import time
 import shutil
+import threading
 import requests
 import jwt
 
-from deepmap_cli.utils import init_headers, print_formatted_json
+from deepmap_cli.utils import init_headers, print_formatted_json,\
+    iter_json_array, peak_rss
 from deepmap_cli.constants import DIR_PATH, TOKEN_PATH, USER_CONFIG_PATH,\
-    DEFAULT_PERMISSIONS, DIR_PERMISSIONS
+    DEFAULT_PERMISSIONS, DIR_PERMISSIONS, VERSION_FILENAME, SEARCH_CHUNK_SIZE,\
+    ASYNC_CHUNK_SIZE, INDEX_FILENAME, BLOB_STORE_DIRNAME
+from deepmap_cli.scheduler import DownloadScheduler, iter_concurrently
+from deepmap_cli.async_engine import AsyncDownloadScheduler
+from deepmap_cli.writer import TileWriter, collect_garbage, is_blob_store,\
+    remove_partials
+from deepmap_cli.trace import tracer
+from deepmap_cli.tile_index import TileIndex
+from deepmap_cli.journal import JobJournal
+from deepmap_cli.metadata import update_cache, map_formats, ids, check_formats
+from deepmap_cli.completion import completion_script
+from deepmap_cli.planner import plan_tiles, record_throughput
+from deepmap_cli.geo import tile_center, distance, distance_to_route,\
+    hilbert_index
 
 
 def get_token():
@@ -141,38 +157,390 @@ def _create(args, server_url):
     print_formatted_json(response.json())
 
 def _download_tiles_in_bbox(args, server_url):
+    """ Downloads the tiles of one or more maps and formats within a bounding
+    box.
+
+    The searches for every combination of map and format run concurrently.
+    Their responses are parsed as they stream in, and each tile is queued for
+    download as soon as it is decoded, so downloading overlaps the searches.
+
+    The download is a job in the job journal, which records every tile found
+    and downloaded, so an interrupted job can be resumed with "jobs resume".
+
+    Args:
+        args: A namespace of parameters automatically generated by the parser.
+        server_url: String representing the base url of the API.
+    """
+    map_ids = args.id.split(',')
+    formats = args.format.split(',')
+    if args.convert and 'PoseTile' not in formats:
+        sys.exit("--convert {} requires the PoseTile format.".format(
+            args.convert))
+    if args.merge and 'GeoJsonTile' not in formats and 'geojson' not in formats:
+        sys.exit("--merge requires the GeoJsonTile format.")
+    if args.merge and len(map_ids) > 1:
+        sys.exit("--merge requires a single map.")
+
     token = get_token()
     headers = init_headers(token)
 
-    from deepmap_sdk.tiles import search_tiles
-    print(locals().keys())
-    search_url = locals()['search_tiles'](args.id,
-                                       server_url,
-                                       args.z,
-                                       args.lat1,
-                                       args.lat2,
-                                       args.lng1,
-                                       args.lng2,
-                                       args.format,
-                                       args.before,
-                                       args.after)
-    response = requests.get(search_url, headers=headers)
-    tiles = response.json()
-    response.close()
+    from deepmap_sdk.tiles import search_tiles, download_tile
+
+    pairs = [(map_id, format) for map_id in map_ids for format in formats]
+    writer = journal = job_id = None
+    if not args.plan:
+        writer = _writer_from_args(args)
+        # Tiles are only journaled as done once their files are in place.
+        journal = JobJournal(before_commit=writer.flush)
+        job_id = getattr(args, 'job_id', None)
+        if job_id is None:
+            job_id = journal.create(args, pairs)
+            print("Started job {}".format(job_id), file=sys.stderr)
+        else:
+            journal.start(job_id)
+
+    searches = []
+    stats = {}
+    for map_id, format in pairs:
+        if journal is not None and journal.searched(job_id, map_id, format):
+            searches.append(
+                _journal_producer(journal, job_id, map_id, format))
+        else:
+            search_url = search_tiles(map_id, server_url, args.z, args.lat1,
+                                      args.lat2, args.lng1, args.lng2, format,
+                                      args.before, args.after)
+            search = _search_producer(search_url, headers, map_id, format)
+            if journal is not None:
+                search = _journaled_search(search, journal, job_id, map_id,
+                                           format)
+            searches.append(search)
+        stats['{}/{}'.format(map_id, format)] = {
+            'tiles': 0,
+            'downloaded': 0,
+            'failed': 0,
+            'bytes': 0
+        }
+    # Jobs are (map_id, format, tile) tuples.
+    jobs = iter_concurrently(searches)
+
+    def tile_url(job):
+        map_id, format, tile = job
+        return download_tile(map_id, server_url, tile['z'], tile['x'],
+                             tile['y'], format, tile['release_timestamp'],
+                             tile['release_timestamp'])
+
+    def tile_dest(job):
+        map_id, format, tile = job
+        return _tile_dest(args.dest_folder, format, map_id, tile['x'],
+                          tile['y'], tile['z'])
+
+    if args.plan:
+        index = None
+        if os.path.isfile(os.path.join(args.dest_folder, INDEX_FILENAME)):
+            index = TileIndex(args.dest_folder, readonly=True)
+
+        def is_current(job, dest):
+            # Files are only known to be of the searched release through
+            # the index of the folder.
+            recorded = index.release_timestamp(dest) if index else None
+            return recorded is not None and \
+                str(recorded) == str(job[2].get('release_timestamp'))
+
+        try:
+            print_formatted_json(
+                plan_tiles(jobs, tile_dest, tile_url, headers, args.head,
+                           args.workers,
+                           size_for=lambda job: job[2].get('size'),
+                           is_current=is_current))
+        finally:
+            if index is not None:
+                index.close()
+        return
+
+    lock = threading.Lock()
+
+    def finished(job, dest, size):
+        map_id, format, tile = job
+        with lock:
+            stat = stats['{}/{}'.format(map_id, format)]
+            stat['downloaded'] += 1
+            stat['bytes'] += size
+        if index is not None:
+            index.add(dest, map_id, format, tile['x'], tile['y'], tile['z'],
+                      size, tile['release_timestamp'])
+        journal.set_tile(job_id, job, 'done')
+
+    def failed(job):
+        # A failed tile is planned again, for a resumed run to retry.
+        journal.set_tile(job_id, job, 'planned')
+
+    def download(job):
+        map_id, format, tile = job
+        journal.set_tile(job_id, job, 'in_flight')
+        dest = None
+        try:
+            dest, size = _download_tile_by_url(tile_url(job),
+                                               args.dest_folder, format,
+                                               map_id, tile['x'], tile['y'],
+                                               tile['z'], headers=headers,
+                                               writer=writer)
+            if dest is not None:
+                finished(job, dest, size)
+        finally:
+            if dest is None:
+                failed(job)
+        return dest
+
+    order = _tile_priority(args)
+    priority = (lambda job: order(job[2])) if order else None
+    # A bounded queue would only order a window of the tiles. With an order
+    # every tile found is queued while the searches go on, and the workers
+    # take the first of the tiles found so far.
+    max_pending = 0 if priority is not None else 1024
+    index = TileIndex(args.dest_folder) if args.dest_folder else None
+    if args.engine == 'async':
+
+        def request_for(job):
+            journal.set_tile(job_id, job, 'in_flight')
+            return tile_url(job), tile_dest(job)
+
+        scheduler = AsyncDownloadScheduler(
+            request_for,
+            writer,
+            finished,
+            failed=failed,
+            headers=headers,
+            workers=args.workers,
+            max_pending=max_pending,
+            priority=priority,
+            # Every download in flight holds a chunk, so --buffer_size only
+            # lowers the chunk size.
+            chunk_size=min(args.buffer_size, ASYNC_CHUNK_SIZE))
+    else:
+        scheduler = DownloadScheduler(download,
+                                      workers=args.workers,
+                                      max_pending=max_pending,
+                                      priority=priority)
+    if getattr(args, 'job_id', None) is not None:
+        # Writes cut short with the earlier run left their temp files behind.
+        remove_partials(
+            tile_dest(job) for map_id, format in pairs
+            for job in journal.pending(job_id, map_id, format))
+    with tracer.span('download tiles', engine=args.engine,
+                     workers=args.workers) as attributes:
+        start = time.time()
+        scheduler.start()
+        try:
+            for job in jobs:
+                stats['{}/{}'.format(job[0], job[1])]['tiles'] += 1
+                scheduler.put(job)
+        finally:
+            scheduler.join()
+            writer.flush()
+            if index is not None:
+                index.close()
+            journal.commit()
+        seconds = time.time() - start
+        attributes['bytes'] = sum(stat['bytes'] for stat in stats.values())
+        attributes['bytes_per_second'] = attributes['bytes'] / max(seconds, 1e-9)
+        attributes['peak_rss_bytes'] = peak_rss()
+
+    record_throughput(attributes['bytes'], seconds)
+    for stat in stats.values():
+        stat['failed'] = stat['tiles'] - stat['downloaded']
+    if len(stats) > 1:
+        print_formatted_json(stats)
+    print("Downloaded {} tiles".format(scheduler.completed))
+    if scheduler.failed:
+        print("Failed to download {} tiles".format(scheduler.failed),
+              file=sys.stderr)
+
+    # Tiles downloaded by earlier runs of a resumed job count as well.
+    written = [(map_id, format, tile_dest((map_id, format, tile)))
+               for map_id, format, tile in journal.done(job_id)]
+    if journal.end(job_id) == 'incomplete':
+        print("Job {} is incomplete, resume it with 'deepmap jobs resume {}'".
+              format(job_id, job_id),
+              file=sys.stderr)
+    journal.close()
+
+    if args.convert:
+        for map_id in map_ids:
+            _convert_poses(args, map_id, sorted(
+                dest for written_id, format, dest in written
+                if written_id == map_id and format == 'PoseTile'))
+    if args.merge:
+        _merge_geojson(args, sorted(
+            dest for _, format, dest in written
+            if format in ('GeoJsonTile', 'geojson')))
+
+
+def _search_producer(search_url, headers, map_id, format):
+    """ Returns a producer of the download jobs of a tile search.
 
-    for tile in tiles:
-        print(tile)
-        from deepmap_sdk.tiles import download_tile
-        url = locals()['download_tile'](args.id,
-                                       server_url,
-                                       tile['z'],
-                                       tile['x'],
-                                       tile['y'],
-                                       args.format,
-                                       tile['release_timestamp'],
-                                       tile['release_timestamp'])
-        _download_tile_by_url(url, args.dest_folder, args.format, args.id,tile['x'], tile['y'], tile['z'])
-    print("Downloaded {} tiles".format(len(tiles)))
+    Args:
+        search_url: The url of the search.
+        headers: The headers of the search request.
+        map_id: The id of the searched map.
+        format: The searched format.
+    Returns:
+        A function that streams the search and puts a (map_id, format, tile)
+        job for each tile found. It returns True if the search succeeded.
+    """
+
+    def produce(put):
+        with tracer.span('search tiles', map_id=map_id, format=format) as attributes, \
+                requests.get(search_url, headers=headers, stream=True) as response:
+            if response.status_code != 200:
+                print_formatted_json(response.json(), fd=sys.stderr)
+                return False
+            attributes['tiles'] = 0
+            for tile in iter_json_array(
+                    response.iter_content(chunk_size=SEARCH_CHUNK_SIZE)):
+                attributes['tiles'] += 1
+                put((map_id, format, tile))
+            return True
+
+    return produce
+
+
+def _journaled_search(search, journal, job_id, map_id, format):
+    """ Returns a producer that records the tiles of a search in a job's
+    journal, and only puts the tiles that are not done yet.
+
+    Args:
+        search: The producer returned by _search_producer.
+        journal: The JobJournal of the job.
+        job_id: The id of the job.
+        map_id: The searched map.
+        format: The searched format.
+    """
+
+    def produce(put):
+
+        def plan(job):
+            if journal.plan(job_id, job):
+                put(job)
+
+        if search(plan):
+            journal.finish_search(job_id, map_id, format)
+
+    return produce
+
+
+def _journal_producer(journal, job_id, map_id, format):
+    """ Returns a producer of the tiles of a completed search of a job that
+    are not done, read from the journal instead of searching again.
+
+    Args:
+        journal: The JobJournal of the job.
+        job_id: The id of the job.
+        map_id: The searched map.
+        format: The searched format.
+    """
+
+    def produce(put):
+        for job in journal.pending(job_id, map_id, format):
+            put(job)
+
+    return produce
+
+
+def _tile_priority(args):
+    """ Returns the function ordering the tile downloads of a bounding box.
+
+    Args:
+        args: A namespace of parameters automatically generated by the parser.
+    Returns:
+        A function of a tile returning its priority, lowest first, or None to
+        download tiles in search order.
+    """
+    if args.order == 'center':
+        if args.center:
+            lat, lng = args.center
+        else:
+            lat = (float(args.lat1) + float(args.lat2)) / 2
+            lng = (float(args.lng1) + float(args.lng2)) / 2
+
+        def center_distance(tile):
+            center = tile_center(int(tile['x']), int(tile['y']), int(tile['z']))
+            return distance(lat, lng, center[0], center[1])
+
+        return center_distance
+    if args.order == 'route':
+        if not args.route:
+            sys.exit("--order route requires --route.")
+        route = _read_route(args.route)
+
+        def route_distance(tile):
+            center = tile_center(int(tile['x']), int(tile['y']), int(tile['z']))
+            return distance_to_route(center[0], center[1], route)
+
+        return route_distance
+    if args.order == 'hilbert':
+        return lambda tile: hilbert_index(int(tile['x']), int(tile['y']),
+                                          int(tile['z']))
+    return None
+
+
+def _read_route(path):
+    """ Reads a route polyline from a file with one "lat,lng" point per line.
+
+    Args:
+        path: Path of the route file.
+    Returns:
+        A list of (lat, lng) points.
+    """
+    route = []
+    with open(path, mode='r') as route_file:
+        for line in route_file:
+            if line.strip():
+                lat, lng = line.split(',')
+                route.append((float(lat), float(lng)))
+    if not route:
+        sys.exit("The route in {} has no points.".format(path))
+    return route
+
+
+def _convert_poses(args, map_id, paths):
+    """ Converts the downloaded PoseTile csv files of a bounding box into one
+    columnar file.
+
+    Args:
+        args: A namespace of parameters automatically generated by the parser.
+        map_id: The id of the map the tiles belong to.
+        paths: Paths of the downloaded PoseTile csv files.
+    """
+    from deepmap_cli.convert import convert_poses
+
+    output_format = args.convert.split('=')[1]
+    dest = '{}/{}_{}_{}_{}_{}_{}_{}.{}'.format(args.dest_folder or '.',
+                                               'PoseTile', map_id, args.z,
+                                               args.lat1, args.lat2, args.lng1,
+                                               args.lng2, output_format)
+    count = convert_poses(paths, dest, output_format)
+    print("Converted {} poses to {}".format(count, dest))
+
+
+def _merge_geojson(args, paths):
+    """ Merges the downloaded GeoJsonTile archives of a bounding box into one
+    file.
+
+    Args:
+        args: A namespace of parameters automatically generated by the parser.
+        paths: Paths of the downloaded GeoJsonTile archives.
+    """
+    from deepmap_cli.merge import merge_geojson
+
+    bbox = None
+    if args.clip:
+        lats = sorted([float(args.lat1), float(args.lat2)])
+        lngs = sorted([float(args.lng1), float(args.lng2)])
+        bbox = (lngs[0], lats[0], lngs[1], lats[1])
+    count, duplicates = merge_geojson(paths, args.merge, args.merge_format,
+                                      bbox)
+    print("Merged {} features into {}, skipped {} duplicates".format(
+        count, args.merge, duplicates))
 
 
 def _download(args, server_url):
@@ -187,11 +555,17 @@ def _download(args, server_url):
     from deepmap_sdk.maps import download_distribution
 
     if args.download_target:
-        if args.download_target == 'distribution':
+        if args.download_target == 'distribution' and args.update:
+            _update_distribution(args, server_url)
+            return
+        elif args.download_target == 'distribution':
             url = locals()['download_' + args.download_target](args.id,
                                                                server_url,
                                                                args.format,
                                                                args.version)
+            if args.plan:
+                _plan_distribution(url, args)
+                return
         elif args.download_target == 'tile':
             url = locals()['download_' + args.download_target](args.id,
                                                                server_url,
@@ -201,6 +575,8 @@ def _download(args, server_url):
                                                                args.format,
                                                                args.before,
                                                                args.after)
+            _download_single_tile(url, args)
+            return
         elif args.download_target == 'tile_bbox':
             _download_tiles_in_bbox(args, server_url)
             return
@@ -214,6 +590,165 @@ def _download(args, server_url):
 
     _download_tile_by_url_with_args(url, args)
 
+
+def _plan_distribution(url, args):
+    """ Prints how much downloading a distribution would transfer.
+
+    Args:
+        url: The download url of the distribution.
+        args: A namespace of parameters automatically generated by the parser.
+    """
+    token = get_token()
+    headers = init_headers(token)
+    dest = '{}/{}_{}.tar.gz'.format(args.dest_folder, args.id, args.format)
+    print_formatted_json(
+        plan_tiles([{}], lambda tile: dest, lambda tile: url, headers,
+                   head=True))
+
+
+def _update_distribution(args, server_url):
+    """ Updates a local tile copy of a distribution by downloading only the
+    tiles that changed between the local version and the requested version.
+
+    The changed tiles are written into a staging folder that starts out as a
+    hard linked copy of dest_folder, which then replaces dest_folder once every
+    tile has been downloaded. An update interrupted while downloading leaves
+    the local copy as it was. The replacement takes two renames, and an update
+    interrupted between them is finished by the next run.
+
+    Args:
+        args: A namespace of parameters automatically generated by the parser.
+        server_url: String representing the base url of the API.
+    """
+    if not args.z:
+        sys.exit("--z is required with --update.")
+    if not args.format:
+        sys.exit("--format is required with --update.")
+
+    dest_folder = os.path.normpath(args.dest_folder)
+    if not args.plan:
+        # A plan is a dry run, it leaves an interrupted update as it is.
+        _replace_with_update(dest_folder)
+    if not os.path.isdir(dest_folder):
+        sys.exit("No local copy found at {}.".format(dest_folder))
+
+    from_version = args.update_from or _read_local_version(dest_folder)
+    if not from_version:
+        sys.exit("The version of the local copy is unknown. Pass it with --update_from.")
+
+    token = get_token()
+    headers = init_headers(token)
+
+    from deepmap_sdk.tiles import list_tiles_diff, download_tile
+    diff_url = list_tiles_diff(args.id, server_url, args.z, args.format,
+                               args.version, from_version)
+    response = requests.get(diff_url, headers=headers)
+    if response.status_code != 200:
+        print_formatted_json(response.json(), fd=sys.stderr)
+        return
+    tiles = response.json()
+    response.close()
+
+    if args.plan:
+        print_formatted_json(
+            plan_tiles(
+                tiles, None, lambda tile: download_tile(
+                    args.id, server_url, tile['z'], tile['x'], tile['y'],
+                    args.format, tile['release_timestamp'],
+                    tile['release_timestamp']), headers, head=True))
+        return
+
+    # Stage the update next to the local copy so the final renames stay on
+    # the same filesystem, and hard link the unchanged tiles instead of
+    # copying them.
+    staging = dest_folder + '.update'
+    if os.path.isdir(staging):
+        shutil.rmtree(staging)
+    shutil.copytree(dest_folder, staging, copy_function=os.link)
+    staged_index = os.path.join(staging, INDEX_FILENAME)
+    if os.path.exists(staged_index):
+        # The index is updated in place, so it needs a copy of its own.
+        os.remove(staged_index)
+        shutil.copy2(os.path.join(dest_folder, INDEX_FILENAME), staged_index)
+    index = TileIndex(staging)
+
+    # The writer renames each tile over its hard link, which leaves the
+    # linked tile in the local copy untouched.
+    writer = _writer_from_args(args, staging)
+    to_version = args.version
+    for tile in tiles:
+        url = download_tile(args.id, server_url, tile['z'], tile['x'],
+                            tile['y'], args.format, tile['release_timestamp'],
+                            tile['release_timestamp'])
+        dest, size = _download_tile_by_url(url, staging, args.format,
+                                           args.id, tile['x'], tile['y'],
+                                           tile['z'], headers=headers,
+                                           writer=writer)
+        if dest is None:
+            index.close()
+            shutil.rmtree(staging)
+            sys.exit("Update aborted, {} is unchanged.".format(dest_folder))
+        index.add(dest, args.id, args.format, tile['x'], tile['y'], tile['z'],
+                  size, tile['release_timestamp'])
+        if not args.version and (to_version is None or int(
+                tile['release_timestamp']) > int(to_version)):
+            to_version = tile['release_timestamp']
+
+    writer.flush()
+    index.close()
+
+    version_path = os.path.join(staging, VERSION_FILENAME)
+    if os.path.exists(version_path):
+        os.remove(version_path)
+    with open(version_path, mode='w') as version_file:
+        print(to_version or from_version, file=version_file, end='')
+
+    os.rename(staging, dest_folder + '.ready')
+    _replace_with_update(dest_folder)
+    print("Updated {} tiles from version {} to {}".format(
+        len(tiles), from_version, to_version or from_version))
+
+
+def _replace_with_update(dest_folder):
+    """ Replaces a local copy with its complete update, if there is one.
+
+    The complete update is dest_folder + '.ready', and the local copy is moved
+    aside to dest_folder + '.previous' before the update takes its place.
+    Since the two renames are separate steps, this is also run before every
+    update: whichever step an earlier run stopped at, it finishes the
+    replacement, or puts the local copy back if there is nothing to finish.
+
+    Args:
+        dest_folder: The folder holding the local copy.
+    """
+    ready = dest_folder + '.ready'
+    previous = dest_folder + '.previous'
+    if os.path.isdir(ready):
+        if os.path.isdir(dest_folder):
+            if os.path.isdir(previous):
+                shutil.rmtree(previous)
+            os.rename(dest_folder, previous)
+        os.rename(ready, dest_folder)
+    elif os.path.isdir(previous) and not os.path.exists(dest_folder):
+        os.rename(previous, dest_folder)
+    if os.path.isdir(previous):
+        shutil.rmtree(previous)
+
+
+def _read_local_version(dest_folder):
+    """ Reads the version recorded by the last update of a local copy.
+
+    Args:
+        dest_folder: The folder holding the local copy.
+    Returns:
+        The recorded version, or None if the copy has never been updated.
+    """
+    path = os.path.join(dest_folder, VERSION_FILENAME)
+    if not os.path.isfile(path):
+        return None
+    with open(path, mode='r') as version_file:
+        return version_file.readline().strip()
+
 def _download_tile_by_url_with_args(url, args):
     token = get_token()
     headers = init_headers(token)
@@ -227,40 +762,106 @@ def _download_tile_by_url_with_args(url, args):
                     dest = '{}/{}_{}_{}_{}_{}.tar.gz'.format(args.dest_folder, args.format, args.id, args.x, args.y, args.z)
                 else:
                     dest = '{}/{}_{}.tar.gz'.format(args.dest_folder, args.id, args.format)
-            fdst = open(dest, 'wb')
             print("write to dest {}".format(dest))
-            shutil.copyfileobj(response.raw, fdst)
-            fdst.close()
+            writer = _writer_from_args(args)
+            writer.write(response.raw, dest, _content_length(response))
+            # A single file never fills an fsync batch.
+            writer.flush()
         else:
             print_formatted_json(response.json(), fd=sys.stderr)
         response.close()
 
-def _download_tile_by_url(url, dest_folder, format, id=None, x=None, y=None, z=None):
-    token = get_token()
-    headers = init_headers(token)
-    with requests.get(url, headers=headers, stream=True) as response:
+def _download_single_tile(url, args):
+    """ Downloads the tile of download tile and adds it to the index of
+    dest_folder, like the tiles of download tile_bbox.
+
+    Args:
+        url: The download url of the tile.
+        args: A namespace of parameters automatically generated by the parser.
+    """
+    writer = _writer_from_args(args)
+    dest, size = _download_tile_by_url(url, args.dest_folder, args.format,
+                                       args.id, args.x, args.y, args.z,
+                                       writer=writer)
+    writer.flush()
+    if dest is not None and args.dest_folder:
+        index = TileIndex(args.dest_folder)
+        index.add(dest, args.id, args.format, args.x, args.y, args.z, size)
+        index.close()
+
+
+def _download_tile_by_url(url, dest_folder, format, id=None, x=None, y=None, z=None,
+                          headers=None, writer=None):
+    if headers is None:
+        token = get_token()
+        headers = init_headers(token)
+    if writer is None:
+        writer = TileWriter()
+    with tracer.span('download tile', map_id=id, format=format, x=x, y=y,
+                     z=z), \
+            requests.get(url, headers=headers, stream=True) as response:
         if response.status_code == 200:
-            dest = "result"
-            if len(dest_folder) > 0:
-                if format == "LMapTile3D" or format == "lmap":
-                    dest = '{}/{}_{}_{}_{}_{}.pb.bin'.format(dest_folder, format, id, x, y, z)
-                elif format == "GeoJsonTile" or format == "geojson":
-                    dest = '{}/{}_{}_{}_{}_{}.tar.gz'.format(dest_folder, format, id, x, y, z)
-                elif format == "PoseTile":
-                    dest = '{}/{}_{}_{}_{}_{}.csv'.format(dest_folder, format, id, x, y, z)
-                elif format == "SelfContainedFeatureTile":
-                    dest = '{}/{}_{}_{}_{}_{}.pb.bin'.format(dest_folder, format, id, x, y, z)
-                elif format == "OMapTile":
-                    dest = '{}/{}_{}_{}_{}_{}.pb.bin'.format(dest_folder, format, id, x, y, z)
-                else:
-                    dest = '{}/{}_{}.tar.gz'.format(dest_folder, id, format)
-            fdst = open(dest, 'wb')
+            dest = _tile_dest(dest_folder, format, id, x, y, z)
             print("write to dest {}".format(dest))
-            shutil.copyfileobj(response.raw, fdst)
-            fdst.close()
-        else:
-            print_formatted_json(response.json(), fd=sys.stderr)
-        response.close()
+            size = writer.write(response.raw, dest, _content_length(response))
+            return dest, size
+        print_formatted_json(response.json(), fd=sys.stderr)
+        return None, 0
+
+def _writer_from_args(args, dest_folder=None):
+    """ Creates the file writer configured by the download arguments.
+
+    Args:
+        args: A namespace of parameters automatically generated by the parser.
+        dest_folder: Optional: The folder written to, if not args.dest_folder.
+    Returns:
+        A TileWriter.
+    """
+    blob_store = None
+    if args.dedup or args.blob_store:
+        blob_store = args.blob_store or os.path.join(
+            dest_folder or args.dest_folder or '.', BLOB_STORE_DIRNAME)
+    return TileWriter(buffer_size=args.buffer_size,
+                      fsync_batch=args.fsync_batch,
+                      blob_store=blob_store)
+
+
+def _content_length(response):
+    """ Returns the Content-Length of a response, or None if it is not set.
+
+    Args:
+        response: A response object.
+    """
+    length = response.headers.get('Content-Length')
+    return int(length) if length and length.isdigit() else None
+
+
+def _tile_dest(dest_folder, format, id=None, x=None, y=None, z=None):
+    """ Returns the local path a downloaded tile is saved to.
+
+    Args:
+        dest_folder: The folder tiles are saved into.
+        format: The format of the tile.
+        id: The id of the map.
+        x: The x offset of the tile.
+        y: The y offset of the tile.
+        z: The zoom level of the tile.
+    Returns:
+        The path of the tile.
+    """
+    if len(dest_folder) == 0:
+        return "result"
+    if format == "LMapTile3D" or format == "lmap":
+        return '{}/{}_{}_{}_{}_{}.pb.bin'.format(dest_folder, format, id, x, y, z)
+    if format == "GeoJsonTile" or format == "geojson":
+        return '{}/{}_{}_{}_{}_{}.tar.gz'.format(dest_folder, format, id, x, y, z)
+    if format == "PoseTile":
+        return '{}/{}_{}_{}_{}_{}.csv'.format(dest_folder, format, id, x, y, z)
+    if format == "SelfContainedFeatureTile":
+        return '{}/{}_{}_{}_{}_{}.pb.bin'.format(dest_folder, format, id, x, y, z)
+    if format == "OMapTile":
+        return '{}/{}_{}_{}_{}_{}.pb.bin'.format(dest_folder, format, id, x, y, z)
+    return '{}/{}_{}.tar.gz'.format(dest_folder, id, format)
 
 def _list(args, server_url):
     """ Requests a list of the target objects.
@@ -306,6 +907,14 @@ def _list(args, server_url):
         )
 
     response = requests.get(url, headers=headers)
+    if response.status_code == 200:
+        # Keep the completion of map ids, formats and token ids up to date.
+        if args.list_target == 'maps':
+            update_cache(maps=map_formats(response.json()))
+        elif args.list_target == 'tokens':
+            update_cache(**{
+                args.list_tokens_target + '_tokens': ids(response.json())
+            })
     print_formatted_json(response.json())
 
 def _search(args, server_url):
@@ -347,6 +956,141 @@ def _search(args, server_url):
     response = requests.get(url, headers=headers)
     print_formatted_json(response.json())
 
+def _query(args, server_url):
+    """ Looks up downloaded tiles in the local index, without any request.
+
+    Args:
+        args: A namespace of parameters automatically generated by the parser.
+        server_url: String representing the base url of the API.
+    """
+    if not args.query_target:
+        sys.exit(
+            "Missing a positional argument. Use -h after your command to get help information."
+        )
+    if not os.path.isdir(args.dest_folder):
+        sys.exit("No downloaded tiles found at {}.".format(args.dest_folder))
+
+    if (args.lat2 is None) != (args.lng2 is None):
+        sys.exit("--lat2 and --lng2 must be given together.")
+    if args.rebuild:
+        index = TileIndex(args.dest_folder)
+        print("Indexed {} tiles".format(index.rebuild()), file=sys.stderr)
+    elif os.path.isfile(os.path.join(args.dest_folder, INDEX_FILENAME)):
+        index = TileIndex(args.dest_folder, readonly=True)
+    else:
+        sys.exit("No tile index found in {}. Index the tiles downloaded "
+                 "into it with --rebuild.".format(args.dest_folder))
+    tiles = index.query(args.lat, args.lng, args.lat2, args.lng2, args.id,
+                        args.format)
+    index.close()
+    print_formatted_json(tiles)
+
+
+def _gc(args, server_url):
+    """ Removes the blobs of a blob store that no downloaded file uses anymore.
+
+    Args:
+        args: A namespace of parameters automatically generated by the parser.
+        server_url: String representing the base url of the API.
+    """
+    blob_store = args.blob_store
+    if os.path.isdir(os.path.join(blob_store, BLOB_STORE_DIRNAME)):
+        blob_store = os.path.join(blob_store, BLOB_STORE_DIRNAME)
+    if not is_blob_store(blob_store):
+        sys.exit("No blob store found at {}. Only folders created as blob "
+                 "stores by --dedup or --blob_store are collected.".format(
+                     args.blob_store))
+    removed, freed = collect_garbage(blob_store)
+    print("Removed {} blobs, freed {} bytes".format(removed, freed))
+
+
+def _jobs(args, server_url):
+    """ Lists, resumes or cancels the jobs of download tile_bbox.
+
+    Args:
+        args: A namespace of parameters automatically generated by the parser.
+        server_url: String representing the base url of the API.
+    """
+    if not args.jobs_target:
+        sys.exit(
+            "Missing a positional argument. Use -h after your command to get help information."
+        )
+
+    journal = JobJournal()
+    if args.jobs_target == 'list':
+        jobs = journal.jobs()
+        journal.close()
+        print_formatted_json([{
+            'id': job['id'],
+            'state': job['state'],
+            'created_at': time.strftime('%Y-%m-%d %H:%M:%S',
+                                        time.localtime(job['created_at'])),
+            'maps': job['args'].get('id'),
+            'formats': job['args'].get('format'),
+            'dest_folder': job['args'].get('dest_folder'),
+            'tiles': job['tiles']
+        } for job in jobs])
+        return
+
+    job = journal.get(args.id)
+    if job is None:
+        journal.close()
+        sys.exit("No job {} found.".format(args.id))
+    if job['state'] == 'running':
+        journal.close()
+        sys.exit("Job {} is running in process {}.".format(
+            args.id, job['pid']))
+    if job['state'] in ('completed', 'cancelled'):
+        journal.close()
+        sys.exit("Job {} is {}.".format(args.id, job['state']))
+
+    if args.jobs_target == 'cancel':
+        journal.cancel(args.id)
+        journal.close()
+        print("Cancelled job {}".format(args.id))
+        return
+
+    journal.close()
+    # Relative paths of the job are relative to where it was started.
+    if not os.path.isdir(job['cwd']):
+        sys.exit("The folder job {} was started in, {}, no longer exists.".
+                 format(args.id, job['cwd']))
+    os.chdir(job['cwd'])
+    resumed = argparse.Namespace(**job['args'])
+    resumed.job_id = args.id
+    _download_tiles_in_bbox(resumed, server_url)
+
+
+def _completion(args, server_url):
+    """ Prints the shell completion script, or refreshes the metadata cache
+    it completes from.
+
+    Args:
+        args: A namespace of parameters automatically generated by the parser.
+        server_url: String representing the base url of the API.
+    """
+    if not args.refresh:
+        from deepmap_cli.cli import build_parser
+        print(completion_script(build_parser(), args.shell))
+        return
+
+    token = get_token()
+    headers = init_headers(token)
+
+    from deepmap_sdk.maps import list_maps
+    from deepmap_sdk.auth import list_api_tokens, list_vehicle_tokens
+
+    lists = {}
+    for name, url, parse in (('maps', list_maps(server_url), map_formats),
+                             ('api_tokens', list_api_tokens(server_url), ids),
+                             ('vehicle_tokens',
+                              list_vehicle_tokens(server_url), ids)):
+        response = requests.get(url, headers=headers)
+        if response.status_code == 200:
+            lists[name] = parse(response.json())
+    update_cache(**lists)
+
+
 def _invite(args, server_url):
     """ Invites a user.
 
@@ -460,4 +1204,14 @@ def make_request(args, server_url):
         args: Namespace generated by the cli parser.
         server_url: Base url for the API server.
     """
-    globals()["_" + args.command](args, server_url)
+    # Leave secrets like the login token out of the trace.
+    attributes = {
+        'cli.' + key: value
+        for key, value in vars(args).items() if key not in ('token', 'trace')
+    }
+    # Catch formats a map does not have before requesting them.
+    if args.command in ('download', 'list', 'search') and getattr(
+            args, 'id', None) and getattr(args, 'format', None):
+        check_formats(args.id.split(','), args.format.split(','))
+    with tracer.span('deepmap ' + args.command, **attributes):
+        globals()["_" + args.command](args, server_url)
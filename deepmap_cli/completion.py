@@ -0,0 +1,220 @@
+""" Deepmap CLI shell completion. """
+
+import argparse
+import shlex
+
+from deepmap_cli.constants import METADATA_CACHE_PATH
+
+# Values of arguments completed from the metadata cache or the file system,
+# set as the completer attribute of their argparse actions.
+MAPS = '@maps'
+FORMATS = '@formats'
+API_TOKENS = '@api_tokens'
+VEHICLE_TOKENS = '@vehicle_tokens'
+DIRECTORIES = '@directories'
+
+# Minutes after which the completion refreshes the cache in the background.
+REFRESH_MINUTES = 60
+
+SCRIPT = r'''# Completion of the deepmap command for bash and zsh, generated by
+# "deepmap completion". Load it with: eval "$(deepmap completion)"
+{zsh}
+_deepmap_cache={cache}
+
+_deepmap_subcommands() {{
+    case $1 in
+{subcommands}
+        *) REPLY='' ;;
+    esac
+}}
+
+_deepmap_options() {{
+    case $1 in
+{options}
+        *) REPLY='' ;;
+    esac
+}}
+
+_deepmap_nargs() {{
+    case $1 in
+{nargs}
+        *) REPLY=0 ;;
+    esac
+}}
+
+_deepmap_values() {{
+    case $1 in
+{values}
+        *) REPLY='' ;;
+    esac
+}}
+
+_deepmap_refresh() {{
+    # Touching the cache keeps other completions from refreshing it as well.
+    if [[ ! -e $_deepmap_cache || -n $(find "$_deepmap_cache" -mmin +{minutes} 2>/dev/null) ]]; then
+        touch "$_deepmap_cache" 2>/dev/null &&
+            ("$1" completion --refresh >/dev/null 2>&1 &)
+    fi
+}}
+
+_deepmap_complete() {{
+    local spec=$1 prefix='' kind id rest words=''
+    case $spec in
+        '') return ;;
+        @directories) COMPREPLY=($(compgen -d -- "$cur")); return ;;
+        @*) ;;
+        *) COMPREPLY=($(compgen -W "$spec" -- "$cur")); return ;;
+    esac
+    _deepmap_refresh "${{COMP_WORDS[0]}}"
+    [[ -r $_deepmap_cache ]] || return
+    # Comma separated lists complete their last element.
+    [[ $cur == *,* ]] && prefix=${{cur%,*}},
+    while read -r kind id rest; do
+        case $spec:$kind in
+            @maps:map | @api_tokens:api_token | @vehicle_tokens:vehicle_token)
+                words="$words $id" ;;
+            @formats:map)
+                [[ -z $maps || ,$maps, == *,$id,* ]] && words="$words $rest" ;;
+        esac
+    done < "$_deepmap_cache"
+    COMPREPLY=($(compgen -P "$prefix" -W "$words" -- "${{cur##*,}}"))
+}}
+
+_deepmap() {{
+    local cur=${{COMP_WORDS[COMP_CWORD]}} path='' word spec='' maps=''
+    local i=1 skip=0 count=0 REPLY
+    # Follow the subcommands and count the positional arguments so far.
+    while (( i < COMP_CWORD )); do
+        word=${{COMP_WORDS[i]}}
+        i=$((i + 1))
+        if (( skip > 0 )); then
+            skip=$((skip - 1))
+            [[ $spec == @maps ]] && maps=$word
+            continue
+        fi
+        if [[ $word == -* ]]; then
+            _deepmap_values "$path|$word"
+            spec=$REPLY
+            _deepmap_nargs "$path|$word"
+            skip=$REPLY
+            continue
+        fi
+        _deepmap_subcommands "$path"
+        if (( count == 0 )) && [[ " $REPLY " == *" $word "* ]]; then
+            path=${{path:+$path }}$word
+        else
+            count=$((count + 1))
+            _deepmap_values "$path|#$count"
+            [[ $REPLY == @maps ]] && maps=$word
+        fi
+    done
+
+    COMPREPLY=()
+    if (( skip > 0 )); then
+        _deepmap_complete "$spec"
+    elif [[ $cur == -* ]]; then
+        _deepmap_options "$path"
+        COMPREPLY=($(compgen -W "$REPLY" -- "$cur"))
+    else
+        _deepmap_subcommands "$path"
+        if (( count == 0 )) && [[ -n $REPLY ]]; then
+            COMPREPLY=($(compgen -W "$REPLY" -- "$cur"))
+        else
+            _deepmap_values "$path|#$((count + 1))"
+            _deepmap_complete "$REPLY"
+        fi
+    fi
+}}
+
+complete -o default -F _deepmap deepmap
+'''
+
+ZSH_PREAMBLE = '''
+if [[ -n $ZSH_VERSION ]]; then
+    autoload -U +X bashcompinit && bashcompinit
+fi
+'''
+
+
+def completion_script(parser, shell='bash'):
+    """ Generates the completion script of a parser.
+
+    Subcommands, options and choices are written into the script, so they
+    complete without starting Python. Map ids, formats and token ids are read
+    from the metadata cache, which the script refreshes in the background
+    once it is REFRESH_MINUTES old.
+
+    Args:
+        parser: The argparse parser of the deepmap command.
+        shell: bash or zsh.
+    Returns:
+        The script.
+    """
+    subcommands = []
+    options = []
+    nargs = []
+    values = []
+    for path, command_parser in _walk(parser, ()):
+        key = ' '.join(path)
+        count = 0
+        option_strings = []
+        for action in command_parser._actions:  # pylint: disable=protected-access
+            if isinstance(action, argparse._SubParsersAction):  # pylint: disable=protected-access
+                subcommands.append(_case(key, ' '.join(action.choices)))
+            elif action.option_strings:
+                option_strings.extend(action.option_strings)
+                if action.nargs == 0:
+                    continue
+                for option in action.option_strings:
+                    option_key = key + '|' + option
+                    nargs.append(
+                        _case(option_key,
+                              action.nargs if isinstance(action.nargs, int)
+                              else 1))
+                    values.append(_case(option_key, _values(action)))
+            else:
+                count += 1
+                values.append(_case(key + '|#' + str(count), _values(action)))
+        options.append(_case(key, ' '.join(option_strings)))
+    return SCRIPT.format(zsh=ZSH_PREAMBLE if shell == 'zsh' else '',
+                         cache=shlex.quote(METADATA_CACHE_PATH),
+                         minutes=REFRESH_MINUTES,
+                         subcommands='\n'.join(subcommands),
+                         options='\n'.join(options),
+                         nargs='\n'.join(nargs),
+                         values='\n'.join(values))
+
+
+def _walk(parser, path):
+    """ Yields the command path and parser of a parser and its subparsers.
+
+    Args:
+        parser: An argparse parser.
+        path: The tuple of subcommands leading to the parser.
+    """
+    yield path, parser
+    for action in parser._actions:  # pylint: disable=protected-access
+        if isinstance(action, argparse._SubParsersAction):  # pylint: disable=protected-access
+            for name, subparser in action.choices.items():
+                yield from _walk(subparser, path + (name, ))
+
+
+def _values(action):
+    """ Returns how the value of an argument completes: a completer like
+    MAPS, its space separated choices, or '' for file names.
+
+    Args:
+        action: The argparse action of the argument.
+    """
+    completer = getattr(action, 'completer', None)
+    if completer:
+        return completer
+    if action.choices:
+        return ' '.join(str(choice) for choice in action.choices)
+    return ''
+
+
+def _case(key, value):
+    """ Returns a case branch of the script setting REPLY to a value. """
+    return '        {}) REPLY={} ;;'.format(shlex.quote(key),
+                                            shlex.quote(str(value)))
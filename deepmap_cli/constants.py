@@ -8,3 +8,13 @@ TOKEN_PATH = os.path.join(DIR_PATH, 'token')
 USER_CONFIG_PATH = os.path.join(DIR_PATH, 'config')
 DEFAULT_PERMISSIONS = stat.S_IWUSR | stat.S_IRUSR  # user read write only
 DIR_PERMISSIONS = DEFAULT_PERMISSIONS | stat.S_IXUSR  # add execute permissions
+VERSION_FILENAME = '.deepmap_version'  # version of a locally updated tile copy
+SEARCH_CHUNK_SIZE = 64 * 1024  # bytes read at a time from a search response
+ASYNC_CHUNK_SIZE = 64 * 1024  # bytes read at a time from a response by the async engine
+DEFAULT_BUFFER_SIZE = 1024 * 1024  # bytes copied at a time into a downloaded file
+INDEX_FILENAME = '.deepmap_index.sqlite'  # spatial index of the tiles in a folder
+THROUGHPUT_PATH = os.path.join(DIR_PATH, 'throughput')  # measured by the last download
+BLOB_STORE_DIRNAME = '.deepmap_blobs'  # default blob store of deduplicated downloads
+BLOB_STORE_MARKER = '.deepmap_blob_store'  # marks a folder as a blob store
+JOURNAL_PATH = os.path.join(DIR_PATH, 'jobs.sqlite')  # journal of bulk download jobs
+METADATA_CACHE_PATH = os.path.join(DIR_PATH, 'metadata_cache')  # maps and tokens for completion
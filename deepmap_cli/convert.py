@@ -0,0 +1,210 @@
+""" Deepmap CLI conversion of downloaded tiles. """
+
+import csv
+import itertools
+import os
+import sys
+
+# Rows parsed and written at a time.
+POSE_CHUNK_ROWS = 64 * 1024
+
+
+def convert_poses(paths, dest, output_format):
+    """ Converts PoseTile csv files into one typed columnar file.
+
+    The csv files are streamed a chunk of rows at a time, so memory use does
+    not depend on the number of poses. They are read twice: once to pick the
+    type of each column from all of its values, then to convert them.
+
+    With output_format 'npy', dest is a structured numpy array with one field
+    per csv column. numpy.load(dest, mmap_mode='r') maps it without reading
+    it, and each field, e.g. poses['timestamp'], is a zero-copy view.
+
+    With output_format 'parquet', dest is a parquet file with one column per
+    csv column, readable with pyarrow.parquet.read_table(dest, memory_map=True).
+
+    Args:
+        paths: Paths of the PoseTile csv files, all with the same header.
+        dest: Path of the file to write.
+        output_format: 'npy' or 'parquet'.
+    Returns:
+        The number of poses written.
+    """
+    try:
+        import numpy
+    except ImportError:
+        sys.exit("Converting poses requires numpy. "
+                 "Install it with 'pip install numpy'.")
+
+    paths = list(paths)
+    if not paths:
+        return 0
+    header, dtype, count = _infer_dtype(paths, numpy)
+
+    tmp = dest + '.part'
+    try:
+        if output_format == 'npy':
+            _poses_to_npy(paths, tmp, header, dtype, count, numpy)
+        elif output_format == 'parquet':
+            count = _poses_to_parquet(paths, tmp, header, dtype, numpy)
+        else:
+            raise ValueError('Unknown pose output format ' + output_format)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    os.replace(tmp, dest)
+    return count
+
+
+def _poses_to_npy(paths, dest, header, dtype, count, numpy):
+    """ Writes the count poses as a structured .npy array. """
+    from numpy.lib.format import open_memmap
+
+    poses = open_memmap(dest, mode='w+', dtype=dtype, shape=(count, ))
+    offset = 0
+    for columns, rows in _iter_chunks(paths, header, dtype, numpy):
+        for name in header:
+            poses[name][offset:offset + rows] = columns[name]
+        offset += rows
+    poses.flush()
+    del poses
+    if offset != count:
+        raise ValueError('Expected {} poses, parsed {}.'.format(count, offset))
+    return count
+
+
+def _poses_to_parquet(paths, dest, header, dtype, numpy):
+    """ Writes the poses as a parquet file, one row group per chunk. """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        sys.exit("Converting poses to parquet requires pyarrow. "
+                 "Install it with 'pip install pyarrow'.")
+
+    schema = pyarrow.schema([(name, pyarrow.from_numpy_dtype(dtype[name]))
+                             for name in header])
+    count = 0
+    writer = pyarrow.parquet.ParquetWriter(dest, schema)
+    try:
+        for columns, rows in _iter_chunks(paths, header, dtype, numpy):
+            writer.write_table(
+                pyarrow.Table.from_arrays(
+                    [pyarrow.array(columns[name]) for name in header],
+                    schema=schema))
+            count += rows
+    finally:
+        writer.close()
+    return count
+
+
+def _infer_dtype(paths, numpy):
+    """ Picks a numpy type for each column from every row of the tiles.
+
+    A column starts out as int64 and is widened as values that do not fit
+    turn up: to float64 for a decimal or empty value, which becomes NaN, and
+    to a unicode string as wide as its longest value for anything else.
+
+    Args:
+        paths: Paths of the PoseTile csv files, all with the same header.
+        numpy: The numpy module.
+    Returns:
+        The header of the files, the structured dtype of a pose and the
+        number of poses.
+    """
+    header = None
+    kinds = []
+    widths = []
+    count = 0
+    for path, reader in _iter_readers(paths):
+        if header is None:
+            header = next(reader, [])
+            kinds = ['i8'] * len(header)
+            widths = [1] * len(header)
+        elif next(reader, header) != header:
+            raise ValueError('{} has a different header than {}.'.format(
+                path, paths[0]))
+        for row in reader:
+            if not row:
+                continue
+            count += 1
+            for index, value in enumerate(_fit(row, len(header))):
+                widths[index] = max(widths[index], len(value))
+                if kinds[index] == 'i8' and not _is_int(value):
+                    kinds[index] = 'f8'
+                if kinds[index] == 'f8' and not _is_float(value):
+                    kinds[index] = 'U'
+    fields = [(name, '<U{}'.format(width) if kind == 'U' else '<' + kind)
+              for name, kind, width in zip(header, kinds, widths)]
+    return header, numpy.dtype(fields), count
+
+
+def _iter_readers(paths):
+    """ Opens the csv files one at a time.
+
+    Yields:
+        The path and a csv reader of each file.
+    """
+    for path in paths:
+        with open(path, newline='') as pose_file:
+            yield path, csv.reader(pose_file)
+
+
+def _iter_chunks(paths, header, dtype, numpy):
+    """ Parses the csv files into typed column arrays, a chunk at a time.
+
+    Args:
+        paths: Paths of the PoseTile csv files.
+        header: The expected header of every file.
+        dtype: The structured dtype of a pose.
+        numpy: The numpy module.
+    Yields:
+        A dict of column name to array, and the number of rows in the chunk.
+    """
+    for path, reader in _iter_readers(paths):
+        if next(reader, header) != header:
+            raise ValueError('{} has a different header than {}.'.format(
+                path, paths[0]))
+        while True:
+            chunk = list(itertools.islice(reader, POSE_CHUNK_ROWS))
+            if not chunk:
+                break
+            rows = [_fit(row, len(header)) for row in chunk if row]
+            if not rows:
+                continue
+            columns = {}
+            for index, name in enumerate(header):
+                field = dtype[name]
+                values = [row[index] for row in rows]
+                if field.kind == 'f':
+                    values = [value or 'nan' for value in values]
+                columns[name] = numpy.array(values).astype(field)
+            yield columns, len(rows)
+
+
+def _fit(row, width):
+    """ Pads a csv row with empty values or cuts it to the header's width. """
+    if len(row) < width:
+        return row + [''] * (width - len(row))
+    return row[:width]
+
+
+def _is_int(value):
+    """ Returns True if the string is an integer that fits in an int64. """
+    try:
+        number = int(value)
+    except ValueError:
+        return False
+    return -2**63 <= number < 2**63
+
+
+def _is_float(value):
+    """ Returns True if the string is a number or empty. """
+    if not value:
+        return True
+    try:
+        float(value)
+    except ValueError:
+        return False
+    return True
@@ -0,0 +1,130 @@
+""" Deepmap CLI web mercator tile math. """
+
+import math
+
+EARTH_RADIUS = 6371008.8  # mean radius in meters
+
+
+def lat_lng_to_tile(lat, lng, z):
+    """ Returns the tile containing a position.
+
+    Tiles follow the web mercator grid, with 2^z x 2^z tiles at zoom level z
+    and (0, 0) at the top left of the map.
+
+    Args:
+        lat: Latitude in degrees.
+        lng: Longitude in degrees.
+        z: Zoom level.
+    Returns:
+        The (x, y) offsets of the tile.
+    """
+    n = 1 << z
+    lat = max(min(lat, 85.0511287798), -85.0511287798)
+    x = int((lng + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tile_bounds(x, y, z):
+    """ Returns the bounding box of a tile.
+
+    Args:
+        x: The x offset of the tile.
+        y: The y offset of the tile.
+        z: Zoom level.
+    Returns:
+        (min_lat, min_lng, max_lat, max_lng) in degrees.
+    """
+    n = 1 << z
+
+    def lat(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2.0 * row / n))))
+
+    return lat(y + 1), x * 360.0 / n - 180.0, lat(y), (x + 1) * 360.0 / n - 180.0
+
+
+def tile_center(x, y, z):
+    """ Returns the (lat, lng) center of a tile. """
+    min_lat, min_lng, max_lat, max_lng = tile_bounds(x, y, z)
+    return (min_lat + max_lat) / 2.0, (min_lng + max_lng) / 2.0
+
+
+def quadkey(x, y, z):
+    """ Returns the quadkey of a tile, a string that shares a prefix with the
+    quadkeys of the tiles it contains.
+
+    Args:
+        x: The x offset of the tile.
+        y: The y offset of the tile.
+        z: Zoom level.
+    """
+    digits = []
+    for level in range(z, 0, -1):
+        mask = 1 << (level - 1)
+        digits.append(str((1 if x & mask else 0) + (2 if y & mask else 0)))
+    return ''.join(digits)
+
+
+def distance(lat1, lng1, lat2, lng2):
+    """ Returns the great circle distance between two positions in meters. """
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = (math.sin((lat2 - lat1) / 2)**2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2)**2)
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def distance_to_route(lat, lng, route):
+    """ Returns the distance in meters from a position to a polyline.
+
+    Segments are measured in a local equirectangular projection around the
+    position, which is accurate for the short distances that matter here.
+
+    Args:
+        lat: Latitude of the position.
+        lng: Longitude of the position.
+        route: List of (lat, lng) points.
+    """
+    if len(route) == 1:
+        return distance(lat, lng, route[0][0], route[0][1])
+    scale = math.cos(math.radians(lat))
+
+    def project(point):
+        return (math.radians(point[1] - lng) * scale * EARTH_RADIUS,
+                math.radians(point[0] - lat) * EARTH_RADIUS)
+
+    nearest = float('inf')
+    points = [project(point) for point in route]
+    for (x1, y1), (x2, y2) in zip(points, points[1:]):
+        dx, dy = x2 - x1, y2 - y1
+        length = dx * dx + dy * dy
+        t = 0.0 if length == 0 else max(0.0, min(1.0, -(x1 * dx + y1 * dy) /
+                                                 length))
+        nearest = min(nearest, math.hypot(x1 + t * dx, y1 + t * dy))
+    return nearest
+
+
+def hilbert_index(x, y, z):
+    """ Returns the position of a tile along a Hilbert curve over the grid.
+
+    Tiles close on the curve are close on the map, so downloading in this
+    order fills in contiguous areas.
+
+    Args:
+        x: The x offset of the tile.
+        y: The y offset of the tile.
+        z: Zoom level.
+    """
+    index = 0
+    size = 1 << z
+    step = size >> 1
+    while step > 0:
+        rx = 1 if x & step else 0
+        ry = 1 if y & step else 0
+        index += step * step * ((3 * rx) ^ ry)
+        if ry == 0:
+            if rx == 1:
+                x = size - 1 - x
+                y = size - 1 - y
+            x, y = y, x
+        step >>= 1
+    return index
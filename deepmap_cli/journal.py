@@ -0,0 +1,365 @@
+""" Deepmap CLI journal of bulk download jobs. """
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from deepmap_cli.constants import JOURNAL_PATH, DEFAULT_PERMISSIONS,\
+    DIR_PERMISSIONS
+
+# Tile state changes between commits while downloading.
+COMMIT_EVERY = 256
+
+# Arguments that are not stored with a job.
+UNSTORED_ARGS = ('token', 'trace', 'job_id')
+
+
+class JobJournal(object):
+    """ A sqlite journal of the tiles planned, in flight and downloaded by
+    bulk download jobs, which survives the process.
+
+    A job records the searches it makes and every tile they find. Once a
+    search is complete, a resumed job takes its tiles from the journal
+    instead of searching again, and skips the tiles that are done.
+
+    Changes are committed in batches, so after a crash up to a batch of tiles
+    that were downloaded are downloaded again. A tile is never committed as
+    done before its file is in place: the before_commit function, e.g. the
+    flush of the file writer, runs ahead of every commit.
+    """
+
+    def __init__(self, path=JOURNAL_PATH, before_commit=None):
+        """ Opens or creates the journal.
+
+        Args:
+            path: Path of the journal database.
+            before_commit: Optional: Function called before each commit.
+        """
+        os.makedirs(os.path.dirname(path), mode=DIR_PERMISSIONS, exist_ok=True)
+        self._before_commit = before_commit
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._done = []
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        os.chmod(path, mode=DEFAULT_PERMISSIONS)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                         'id INTEGER PRIMARY KEY AUTOINCREMENT, args TEXT, '
+                         'cwd TEXT, state TEXT, pid INTEGER, created_at REAL, '
+                         'updated_at REAL, tiles INTEGER)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS searches ('
+                         'job_id INTEGER, map_id TEXT, format TEXT, '
+                         'complete INTEGER, '
+                         'PRIMARY KEY (job_id, map_id, format))')
+        self._db.execute('CREATE TABLE IF NOT EXISTS tiles ('
+                         'job_id INTEGER, map_id TEXT, format TEXT, '
+                         'x INTEGER, y INTEGER, z INTEGER, tile TEXT, '
+                         'state TEXT, '
+                         'PRIMARY KEY (job_id, map_id, format, x, y, z))')
+        self._db.commit()
+
+    def create(self, args, searches):
+        """ Records a new running job.
+
+        Args:
+            args: The namespace of the job's download arguments.
+            searches: The (map_id, format) pairs the job searches.
+        Returns:
+            The id of the job.
+        """
+        stored = {
+            key: value
+            for key, value in vars(args).items() if key not in UNSTORED_ARGS
+        }
+        now = time.time()
+        with self._lock:
+            job_id = self._db.execute(
+                'INSERT INTO jobs (args, cwd, state, pid, created_at, '
+                'updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+                (json.dumps(stored), os.getcwd(), 'running', os.getpid(), now,
+                 now)).lastrowid
+            self._db.executemany(
+                'INSERT OR IGNORE INTO searches VALUES (?, ?, ?, 0)',
+                [(job_id, map_id, format) for map_id, format in searches])
+            self._db.commit()
+        return job_id
+
+    def get(self, job_id):
+        """ Returns a job as a dict, or None if there is no such job.
+
+        Args:
+            job_id: The id of the job.
+        """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT id, args, cwd, state, pid, created_at, updated_at, '
+                'tiles FROM jobs WHERE id = ?', (job_id, )).fetchone()
+        return _job(row) if row else None
+
+    def jobs(self):
+        """ Returns every job as a dict, with the number of its tiles in each
+        state.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT id, args, cwd, state, pid, created_at, updated_at, '
+                'tiles FROM jobs ORDER BY id').fetchall()
+            counts = self._db.execute(
+                'SELECT job_id, state, COUNT(*) FROM tiles '
+                'GROUP BY job_id, state').fetchall()
+        jobs = [_job(row) for row in rows]
+        by_id = {job['id']: job for job in jobs}
+        for job in jobs:
+            job['tiles'] = {
+                'planned': 0,
+                'in_flight': 0,
+                'done': job['tiles'] or 0
+            }
+        for job_id, state, count in counts:
+            if job_id in by_id:
+                by_id[job_id]['tiles'][state] = count
+        return jobs
+
+    def start(self, job_id):
+        """ Marks an existing job as running in this process.
+
+        Args:
+            job_id: The id of the job.
+        """
+        with self._lock:
+            self._db.execute(
+                'UPDATE jobs SET state = ?, pid = ?, updated_at = ? '
+                'WHERE id = ?', ('running', os.getpid(), time.time(), job_id))
+            self._db.commit()
+
+    def searched(self, job_id, map_id, format):
+        """ Returns True if a search of the job is complete.
+
+        Args:
+            job_id: The id of the job.
+            map_id: The searched map.
+            format: The searched format.
+        """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT complete FROM searches WHERE job_id = ? AND '
+                'map_id = ? AND format = ?', (job_id, map_id, format)).fetchone()
+        return bool(row and row[0])
+
+    def finish_search(self, job_id, map_id, format):
+        """ Marks a search complete, once all the tiles it found are planned.
+
+        Args:
+            job_id: The id of the job.
+            map_id: The searched map.
+            format: The searched format.
+        """
+        with self._lock:
+            self._db.execute(
+                'UPDATE searches SET complete = 1 WHERE job_id = ? AND '
+                'map_id = ? AND format = ?', (job_id, map_id, format))
+        self.commit()
+
+    def plan(self, job_id, job):
+        """ Records a tile found by a search.
+
+        Args:
+            job_id: The id of the job.
+            job: The (map_id, format, tile) download job of the tile.
+        Returns:
+            False if the tile is already done, True if it is to be downloaded.
+        """
+        map_id, format, tile = job
+        key = (job_id, map_id, format, tile['x'], tile['y'], tile['z'])
+        with self._lock:
+            inserted = self._db.execute(
+                'INSERT OR IGNORE INTO tiles VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                key + (json.dumps(tile), 'planned')).rowcount
+            if not inserted:
+                row = self._db.execute(
+                    'SELECT state FROM tiles WHERE job_id = ? AND map_id = ? '
+                    'AND format = ? AND x = ? AND y = ? AND z = ?',
+                    key).fetchone()
+                return row[0] != 'done'
+        self._changed()
+        return True
+
+    def pending(self, job_id, map_id, format):
+        """ Returns the download jobs of the tiles of a search that are not
+        done, in the order they were found.
+
+        Args:
+            job_id: The id of the job.
+            map_id: The searched map.
+            format: The searched format.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT tile FROM tiles WHERE job_id = ? AND map_id = ? AND '
+                'format = ? AND state != ? ORDER BY rowid',
+                (job_id, map_id, format, 'done')).fetchall()
+        return [(map_id, format, json.loads(row[0])) for row in rows]
+
+    def done(self, job_id):
+        """ Returns the download jobs of every tile of a job that is done.
+
+        Args:
+            job_id: The id of the job.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT map_id, format, tile FROM tiles WHERE job_id = ? AND '
+                'state = ? ORDER BY rowid', (job_id, 'done')).fetchall()
+        return [(map_id, format, json.loads(tile))
+                for map_id, format, tile in rows]
+
+    def set_tile(self, job_id, job, state):
+        """ Changes the state of a tile.
+
+        Args:
+            job_id: The id of the job.
+            job: The (map_id, format, tile) download job of the tile.
+            state: planned, in_flight or done.
+        """
+        map_id, format, tile = job
+        key = (job_id, map_id, format, tile['x'], tile['y'], tile['z'])
+        with self._lock:
+            if state == 'done':
+                # Recorded by the next commit, after before_commit.
+                self._done.append(key)
+            else:
+                self._db.execute(
+                    'UPDATE tiles SET state = ? WHERE job_id = ? AND '
+                    'map_id = ? AND format = ? AND x = ? AND y = ? AND z = ?',
+                    (state, ) + key)
+        self._changed()
+
+    def end(self, job_id):
+        """ Records the end of a run of a job.
+
+        The job is completed if all its searches are complete and all their
+        tiles are done, and its tiles are then dropped from the journal.
+        Otherwise it is incomplete and can be resumed.
+
+        Args:
+            job_id: The id of the job.
+        Returns:
+            The new state of the job.
+        """
+        self.commit()
+        with self._lock:
+            searching = self._db.execute(
+                'SELECT COUNT(*) FROM searches WHERE job_id = ? AND '
+                'complete = 0', (job_id, )).fetchone()[0]
+            remaining = self._db.execute(
+                'SELECT COUNT(*) FROM tiles WHERE job_id = ? AND state != ?',
+                (job_id, 'done')).fetchone()[0]
+            state = 'incomplete' if searching or remaining else 'completed'
+            if state == 'completed':
+                tiles = self._db.execute(
+                    'SELECT COUNT(*) FROM tiles WHERE job_id = ?',
+                    (job_id, )).fetchone()[0]
+                self._db.execute('DELETE FROM tiles WHERE job_id = ?',
+                                 (job_id, ))
+                self._db.execute(
+                    'UPDATE jobs SET tiles = ? WHERE id = ?', (tiles, job_id))
+            self._db.execute(
+                'UPDATE jobs SET state = ?, updated_at = ? WHERE id = ?',
+                (state, time.time(), job_id))
+            self._db.commit()
+        return state
+
+    def cancel(self, job_id):
+        """ Marks a job cancelled and drops its tiles from the journal.
+
+        Args:
+            job_id: The id of the job.
+        """
+        with self._lock:
+            self._db.execute('DELETE FROM tiles WHERE job_id = ?', (job_id, ))
+            self._db.execute('DELETE FROM searches WHERE job_id = ?',
+                             (job_id, ))
+            self._db.execute(
+                'UPDATE jobs SET state = ?, updated_at = ? WHERE id = ?',
+                ('cancelled', time.time(), job_id))
+            self._db.commit()
+
+    def commit(self):
+        """ Writes the recorded changes to disk.
+
+        The tiles marked done so far are set aside before before_commit
+        runs, and only they are committed as done after it. before_commit
+        runs without the lock, so downloads carry on meanwhile, and the tiles
+        they finish wait for the next commit.
+        """
+        with self._lock:
+            done, self._done = self._done, []
+            self._pending = 0
+        try:
+            if self._before_commit is not None:
+                self._before_commit()
+        except BaseException:
+            with self._lock:
+                self._done = done + self._done
+            raise
+        with self._lock:
+            self._db.executemany(
+                'UPDATE tiles SET state = ? WHERE job_id = ? AND map_id = ? '
+                'AND format = ? AND x = ? AND y = ? AND z = ?',
+                [('done', ) + key for key in done])
+            self._db.commit()
+
+    def close(self):
+        """ Commits and closes the journal. """
+        self.commit()
+        self._db.close()
+
+    def _changed(self):
+        """ Counts a change, committing once a batch of changes is recorded. """
+        with self._lock:
+            self._pending += 1
+            full = self._pending >= COMMIT_EVERY
+        if full:
+            self.commit()
+
+
+def _job(row):
+    """ Returns a row of the jobs table as a dict.
+
+    A running job whose process is gone, e.g. after a crash, is interrupted.
+    """
+    job_id, args, cwd, state, pid, created_at, updated_at, tiles = row
+    if state == 'running' and not _alive(pid):
+        state = 'interrupted'
+    return {
+        'id': job_id,
+        'args': json.loads(args),
+        'cwd': cwd,
+        'state': state,
+        'pid': pid,
+        'created_at': created_at,
+        'updated_at': updated_at,
+        'tiles': tiles
+    }
+
+
+def _alive(pid):
+    """ Returns True if a process is running.
+
+    Args:
+        pid: The id of the process.
+    """
+    if pid == os.getpid():
+        return True
+    if os.name != 'posix':
+        # Signal 0 is not a liveness check on Windows.
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
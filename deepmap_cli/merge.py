@@ -0,0 +1,288 @@
+""" Deepmap CLI merging of downloaded GeoJSON tiles. """
+
+import hashlib
+import json
+import os
+import tarfile
+
+
+def merge_geojson(paths, dest, output_format='geojson', bbox=None):
+    """ Merges the features of GeoJsonTile archives into one file.
+
+    Features are read out of the archives one file at a time and written out
+    as they are read, so no archive is held whole in memory, but each json
+    file of an archive is loaded whole. Features repeated in several tiles,
+    e.g. roads crossing a tile border, are written once: a 16 byte digest of
+    every distinct feature is kept until the merge ends, so memory also grows
+    with the number of features merged.
+
+    Args:
+        paths: Paths of the GeoJsonTile .tar.gz archives.
+        dest: Path of the file to write.
+        output_format: 'geojson' for a FeatureCollection, or 'ndjson' for one
+            feature per line.
+        bbox: Optional: (min_lng, min_lat, max_lng, max_lat) to clip the
+            features to. Features entirely outside of it are dropped.
+    Returns:
+        The number of features written and the number of duplicates skipped.
+    """
+    seen = set()
+    written = 0
+    duplicates = 0
+    tmp = dest + '.part'
+    try:
+        with open(tmp, mode='w') as out:
+            if output_format == 'geojson':
+                out.write('{"type": "FeatureCollection", "features": [\n')
+            for feature in _iter_features(paths):
+                key = _feature_key(feature)
+                if key in seen:
+                    duplicates += 1
+                    continue
+                seen.add(key)
+                if bbox is not None and feature.get('geometry') is not None:
+                    geometry = clip_geometry(feature['geometry'], bbox)
+                    if geometry is None:
+                        continue
+                    feature = dict(feature, geometry=geometry)
+                if output_format == 'geojson' and written:
+                    out.write(',\n')
+                out.write(json.dumps(feature, separators=(',', ':')))
+                if output_format == 'ndjson':
+                    out.write('\n')
+                written += 1
+            if output_format == 'geojson':
+                out.write('\n]}\n')
+    except BaseException:
+        os.remove(tmp)
+        raise
+    os.replace(tmp, dest)
+    return written, duplicates
+
+
+def _iter_features(paths):
+    """ Yields the features of every json file in the given archives.
+
+    Args:
+        paths: Paths of .tar.gz archives.
+    Yields:
+        GeoJSON features.
+    """
+    for path in paths:
+        with tarfile.open(path, mode='r|gz') as archive:
+            for member in archive:
+                if not member.isfile() or not member.name.endswith(
+                        ('.json', '.geojson')):
+                    continue
+                data = json.load(archive.extractfile(member))
+                if data.get('type') == 'FeatureCollection':
+                    for feature in data.get('features', []):
+                        yield feature
+                elif data.get('type') == 'Feature':
+                    yield data
+
+
+def _feature_key(feature):
+    """ Returns a compact key identifying a feature across tiles.
+
+    Features with an id are identified by it, others by their content.
+
+    Args:
+        feature: A GeoJSON feature.
+    """
+    if feature.get('id') is not None:
+        content = 'id:' + json.dumps(feature['id'])
+    else:
+        content = json.dumps(feature, sort_keys=True, separators=(',', ':'))
+    return hashlib.blake2b(content.encode('utf-8'), digest_size=16).digest()
+
+
+def clip_geometry(geometry, bbox):
+    """ Clips a GeoJSON geometry to a bounding box.
+
+    Points are kept if inside the box, lines are cut at its edges and polygon
+    rings are clipped with the Sutherland-Hodgman algorithm.
+
+    Args:
+        geometry: A GeoJSON geometry.
+        bbox: (min_lng, min_lat, max_lng, max_lat).
+    Returns:
+        The clipped geometry, or None if nothing of it is inside the box.
+    """
+    kind = geometry.get('type')
+    coordinates = geometry.get('coordinates')
+    if kind == 'Point':
+        return geometry if _inside(coordinates, bbox) else None
+    if kind == 'MultiPoint':
+        points = [point for point in coordinates if _inside(point, bbox)]
+        return _geometry('MultiPoint', points)
+    if kind == 'LineString':
+        return _lines(_clip_line(coordinates, bbox))
+    if kind == 'MultiLineString':
+        return _lines([
+            part for line in coordinates for part in _clip_line(line, bbox)
+        ])
+    if kind == 'Polygon':
+        return _polygons([_clip_polygon(coordinates, bbox)])
+    if kind == 'MultiPolygon':
+        return _polygons(
+            [_clip_polygon(polygon, bbox) for polygon in coordinates])
+    if kind == 'GeometryCollection':
+        geometries = [clip_geometry(part, bbox) for part in geometry['geometries']]
+        geometries = [part for part in geometries if part is not None]
+        if not geometries:
+            return None
+        return {'type': 'GeometryCollection', 'geometries': geometries}
+    return geometry
+
+
+def _geometry(kind, coordinates):
+    """ Returns a geometry, or None if it has no coordinates. """
+    if not coordinates:
+        return None
+    return {'type': kind, 'coordinates': coordinates}
+
+
+def _lines(lines):
+    """ Returns the simplest geometry for a list of line strings. """
+    if len(lines) == 1:
+        return _geometry('LineString', lines[0])
+    return _geometry('MultiLineString', lines)
+
+
+def _polygons(polygons):
+    """ Returns the simplest geometry for a list of possibly empty polygons. """
+    polygons = [polygon for polygon in polygons if polygon]
+    if len(polygons) == 1:
+        return _geometry('Polygon', polygons[0])
+    return _geometry('MultiPolygon', polygons)
+
+
+def _inside(point, bbox):
+    """ Returns True if a [lng, lat] position is inside the box. """
+    return bbox[0] <= point[0] <= bbox[2] and bbox[1] <= point[1] <= bbox[3]
+
+
+def _clip_line(line, bbox):
+    """ Cuts a line string at the edges of the box.
+
+    Args:
+        line: List of [lng, lat] positions.
+        bbox: (min_lng, min_lat, max_lng, max_lat).
+    Returns:
+        The parts of the line inside the box.
+    """
+    parts = []
+    current = []
+    for start, end in zip(line, line[1:]):
+        segment = _clip_segment(start, end, bbox)
+        if segment is None:
+            if len(current) > 1:
+                parts.append(current)
+            current = []
+            continue
+        if current and current[-1] == segment[0]:
+            current.append(segment[1])
+        else:
+            if len(current) > 1:
+                parts.append(current)
+            current = list(segment)
+    if len(current) > 1:
+        parts.append(current)
+    return parts
+
+
+def _clip_segment(start, end, bbox):
+    """ Clips a segment to the box with the Liang-Barsky algorithm.
+
+    Returns:
+        The clipped [start, end], or None if the segment is outside the box.
+    """
+    d_lng = end[0] - start[0]
+    d_lat = end[1] - start[1]
+    low, high = 0.0, 1.0
+    for p, q in ((-d_lng, start[0] - bbox[0]), (d_lng, bbox[2] - start[0]),
+                 (-d_lat, start[1] - bbox[1]), (d_lat, bbox[3] - start[1])):
+        if p == 0:
+            if q < 0:
+                return None
+            continue
+        t = q / p
+        if p < 0:
+            low = max(low, t)
+        else:
+            high = min(high, t)
+        if low > high:
+            return None
+    clipped_start = start if low == 0 else [
+        start[0] + low * d_lng, start[1] + low * d_lat
+    ]
+    clipped_end = end if high == 1 else [
+        start[0] + high * d_lng, start[1] + high * d_lat
+    ]
+    return [clipped_start, clipped_end]
+
+
+def _clip_polygon(rings, bbox):
+    """ Clips the rings of a polygon to the box.
+
+    Args:
+        rings: List of closed rings, the exterior ring first.
+        bbox: (min_lng, min_lat, max_lng, max_lat).
+    Returns:
+        The clipped rings, or an empty list if the exterior ring is outside
+        the box.
+    """
+    clipped = []
+    for index, ring in enumerate(rings):
+        ring = _clip_ring(ring, bbox)
+        if ring is None:
+            if index == 0:
+                return []
+            continue
+        clipped.append(ring)
+    return clipped
+
+
+def _clip_ring(ring, bbox):
+    """ Clips a closed ring to the box with the Sutherland-Hodgman algorithm.
+
+    Returns:
+        The clipped closed ring, or None if less than a triangle remains.
+    """
+    edges = (
+        (lambda p: p[0] >= bbox[0], lambda a, b: _cross_lng(a, b, bbox[0])),
+        (lambda p: p[0] <= bbox[2], lambda a, b: _cross_lng(a, b, bbox[2])),
+        (lambda p: p[1] >= bbox[1], lambda a, b: _cross_lat(a, b, bbox[1])),
+        (lambda p: p[1] <= bbox[3], lambda a, b: _cross_lat(a, b, bbox[3])),
+    )
+    points = ring[:-1] if len(ring) > 1 and ring[0] == ring[-1] else ring
+    for inside, cross in edges:
+        if not points:
+            break
+        clipped = []
+        previous = points[-1]
+        for point in points:
+            if inside(point):
+                if not inside(previous):
+                    clipped.append(cross(previous, point))
+                clipped.append(point)
+            elif inside(previous):
+                clipped.append(cross(previous, point))
+            previous = point
+        points = clipped
+    if len(points) < 3:
+        return None
+    return points + [points[0]]
+
+
+def _cross_lng(start, end, lng):
+    """ Returns where a segment crosses a meridian. """
+    t = (lng - start[0]) / (end[0] - start[0])
+    return [lng, start[1] + t * (end[1] - start[1])]
+
+
+def _cross_lat(start, end, lat):
+    """ Returns where a segment crosses a parallel. """
+    t = (lat - start[1]) / (end[1] - start[1])
+    return [start[0] + t * (end[0] - start[0]), lat]
@@ -0,0 +1,155 @@
+""" Deepmap CLI local cache of account metadata. """
+
+import os
+import sys
+import tempfile
+import time
+
+from deepmap_cli.constants import METADATA_CACHE_PATH, DEFAULT_PERMISSIONS
+
+# Other names the API accepts for some formats.
+FORMAT_ALIASES = {'lmap': 'LMapTile3D', 'geojson': 'GeoJsonTile'}
+
+
+def read_cache(path=METADATA_CACHE_PATH):
+    """ Reads the cached maps and tokens of the account.
+
+    The cache is a text file the shell completion reads directly, with a line
+    "map <id> <format> ..." for each map, and a line "api_token <id>" or
+    "vehicle_token <id>" for each token.
+
+    Args:
+        path: Path of the cache.
+    Returns:
+        A dict with the formats of each map id under 'maps', the lists of
+        token ids under 'api_tokens' and 'vehicle_tokens', and the time the
+        cache was written under 'written_at', or None if there is no cache.
+    """
+    cache = {'maps': {}, 'api_tokens': [], 'vehicle_tokens': []}
+    try:
+        with open(path, mode='r') as cache_file:
+            cache['written_at'] = os.fstat(cache_file.fileno()).st_mtime
+            for line in cache_file:
+                fields = line.split()
+                if len(fields) < 2:
+                    continue
+                if fields[0] == 'map':
+                    cache['maps'][fields[1]] = fields[2:]
+                elif fields[0] in ('api_token', 'vehicle_token'):
+                    cache[fields[0] + 's'].append(fields[1])
+    except OSError:
+        cache['written_at'] = None
+    return cache
+
+
+def update_cache(maps=None, api_tokens=None, vehicle_tokens=None,
+                 path=METADATA_CACHE_PATH):
+    """ Replaces parts of the cache, keeping the others.
+
+    Args:
+        maps: Optional: A dict of the formats of each map id.
+        api_tokens: Optional: The ids of the API access tokens.
+        vehicle_tokens: Optional: The ids of the vehicle access tokens.
+        path: Path of the cache.
+    """
+    cache = read_cache(path)
+    if maps is not None:
+        cache['maps'] = maps
+    if api_tokens is not None:
+        cache['api_tokens'] = api_tokens
+    if vehicle_tokens is not None:
+        cache['vehicle_tokens'] = vehicle_tokens
+
+    lines = [
+        ' '.join(['map', map_id] + formats)
+        for map_id, formats in sorted(cache['maps'].items())
+    ]
+    lines += ['api_token ' + token_id for token_id in cache['api_tokens']]
+    lines += [
+        'vehicle_token ' + token_id for token_id in cache['vehicle_tokens']
+    ]
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        return
+    # The completion may read the cache at any time, so it is replaced whole.
+    fd, tmp = tempfile.mkstemp(prefix='.metadata_cache.', dir=directory)
+    with os.fdopen(fd, 'w') as cache_file:
+        cache_file.write(''.join(line + '\n' for line in lines))
+    os.chmod(tmp, mode=DEFAULT_PERMISSIONS)
+    os.replace(tmp, path)
+
+
+def map_formats(data):
+    """ Returns the formats of each map in a list maps response.
+
+    Args:
+        data: The json of the response.
+    Returns:
+        A dict of the list of formats of each map id.
+    """
+    maps = {}
+    for item in _items(data):
+        if not isinstance(item, dict) or item.get('id') is None:
+            continue
+        formats = []
+        for format in item.get('formats') or []:
+            if isinstance(format, dict):
+                format = format.get('format') or format.get('name')
+            if format:
+                formats.append(str(format))
+        maps[_word(item['id'])] = [_word(format) for format in formats]
+    return maps
+
+
+def ids(data):
+    """ Returns the ids of the objects in a list response, e.g. of tokens.
+
+    Args:
+        data: The json of the response.
+    """
+    return [
+        _word(item['id']) for item in _items(data)
+        if isinstance(item, dict) and item.get('id') is not None
+    ]
+
+
+def check_formats(map_ids, formats):
+    """ Exits if the cached maps show that a map lacks one of the formats,
+    before a request for it is made.
+
+    Maps missing from the cache are not checked, since they may be newer than
+    the cache.
+
+    Args:
+        map_ids: The ids of the requested maps.
+        formats: The requested formats.
+    """
+    cache = read_cache()
+    for map_id in map_ids:
+        available = cache['maps'].get(map_id)
+        if not available:
+            continue
+        for format in formats:
+            if format in available or FORMAT_ALIASES.get(format) in available:
+                continue
+            sys.exit("Format {} is not available for map {}, its formats are {}.\n"
+                     "The formats are from the list of maps cached at {}, run "
+                     "'deepmap list maps' if the map has changed since.".format(
+                         format, map_id, ', '.join(available),
+                         time.strftime('%Y-%m-%d %H:%M:%S',
+                                       time.localtime(cache['written_at']))))
+
+
+def _items(data):
+    """ Returns the list of objects in a list response, which is either the
+    json list itself or the first list in a json object.
+    """
+    if isinstance(data, dict):
+        data = next(
+            (value for value in data.values() if isinstance(value, list)), [])
+    return data if isinstance(data, list) else []
+
+
+def _word(value):
+    """ Returns a value as a single word of the cache file. """
+    return '_'.join(str(value).split())
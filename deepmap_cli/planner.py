@@ -0,0 +1,142 @@
+""" Deepmap CLI download planning. """
+
+import json
+import os
+import threading
+import time
+
+import requests
+
+from deepmap_cli.constants import DIR_PATH, THROUGHPUT_PATH, DEFAULT_PERMISSIONS
+from deepmap_cli.scheduler import DownloadScheduler
+
+
+def plan_tiles(tiles,
+               dest_for,
+               url_for,
+               headers,
+               head=False,
+               workers=8,
+               size_for=None,
+               is_current=None):
+    """ Works out how much a download would transfer, without downloading.
+
+    Tiles whose file is already on disk are left out. A file only counts as
+    on disk if its size is that of the tile, or if is_current says it is the
+    same release, since a file of unknown size may be an older version. The
+    size of a tile comes from a 'size' field of the tile if it has one, or
+    else from the Content-Length of a HEAD request if head is set.
+
+    Args:
+        tiles: Iterable of tiles, e.g. streamed search results.
+        dest_for: Function returning the local path of a tile. None if no
+            tile can be on disk yet.
+        url_for: Function returning the download url of a tile.
+        headers: Headers of the HEAD requests.
+        head: Whether to send HEAD requests for tiles of unknown size.
+        workers: Number of HEAD requests sent in parallel.
+        size_for: Optional: Function returning the size field of a tile, for
+            tiles that are not dicts.
+        is_current: Optional: Function returning True if the file at the
+            given path is the same release as the tile.
+    Returns:
+        A dict summarizing the download.
+    """
+    lock = threading.Lock()
+    plan = {
+        'tiles': 0,
+        'tiles_on_disk': 0,
+        'tiles_to_download': 0,
+        'tiles_of_unknown_size': 0,
+        'bytes_to_download': 0,
+    }
+
+    def add_tile(size, dest=None):
+        with lock:
+            if dest and size is not None and os.path.isfile(dest) and \
+                    os.path.getsize(dest) == size:
+                plan['tiles_on_disk'] += 1
+                return
+            plan['tiles_to_download'] += 1
+            if size is None:
+                plan['tiles_of_unknown_size'] += 1
+            else:
+                plan['bytes_to_download'] += size
+
+    def head_size(job):
+        tile, dest = job
+        with requests.head(url_for(tile), headers=headers,
+                           allow_redirects=True) as response:
+            length = response.headers.get('Content-Length')
+            if response.status_code != 200 or not length:
+                add_tile(None)
+            else:
+                add_tile(int(length), dest)
+        return True
+
+    scheduler = DownloadScheduler(head_size, workers=workers)
+    scheduler.start()
+    try:
+        for tile in tiles:
+            plan['tiles'] += 1
+            size = size_for(tile) if size_for else tile.get('size')
+            dest = dest_for(tile) if dest_for else None
+            if dest and is_current and os.path.isfile(dest) and \
+                    is_current(tile, dest):
+                plan['tiles_on_disk'] += 1
+            elif size is not None:
+                add_tile(int(size), dest)
+            elif head:
+                scheduler.put((tile, dest))
+            else:
+                add_tile(None)
+    finally:
+        scheduler.join()
+    plan['tiles_to_download'] += scheduler.failed
+    plan['tiles_of_unknown_size'] += scheduler.failed
+
+    known = plan['tiles_to_download'] - plan['tiles_of_unknown_size']
+    estimated_bytes = plan['bytes_to_download']
+    if plan['tiles_of_unknown_size'] and known:
+        # Assume the tiles of unknown size are as large as the others.
+        estimated_bytes += (plan['bytes_to_download'] // known *
+                            plan['tiles_of_unknown_size'])
+    if not plan['tiles_of_unknown_size'] or known:
+        plan['estimated_bytes'] = estimated_bytes
+        throughput = read_throughput()
+        if throughput:
+            plan['bytes_per_second'] = int(throughput)
+            plan['estimated_seconds'] = round(estimated_bytes / throughput, 1)
+    return plan
+
+
+def read_throughput():
+    """ Returns the download throughput measured by the last download.
+
+    Returns:
+        Bytes per second, or None if no download has been measured.
+    """
+    if not os.path.isfile(THROUGHPUT_PATH):
+        return None
+    with open(THROUGHPUT_PATH, mode='r') as throughput_file:
+        try:
+            return json.load(throughput_file)['bytes_per_second']
+        except (ValueError, KeyError):
+            return None
+
+
+def record_throughput(size, seconds):
+    """ Stores the throughput of a download for later estimates.
+
+    Args:
+        size: Number of bytes downloaded.
+        seconds: Time the download took.
+    """
+    if size <= 0 or seconds <= 0 or not os.path.isdir(DIR_PATH):
+        return
+    with open(THROUGHPUT_PATH, mode='w') as throughput_file:
+        json.dump({
+            'bytes_per_second': size / seconds,
+            'measured_at': time.time()
+        }, throughput_file)
+    os.chmod(THROUGHPUT_PATH, mode=DEFAULT_PERMISSIONS)
@@ -0,0 +1,125 @@
+""" Deepmap CLI download scheduling. """
+
+import itertools
+import queue
+import sys
+import threading
+
+
+class DownloadScheduler(object):
+    """ Runs download jobs on a pool of worker threads.
+
+    Jobs can be queued while earlier jobs are already downloading. The queue
+    is bounded, so a producer that is faster than the downloads blocks in put
+    instead of holding every pending job in memory.
+
+    Jobs run in the order they are queued, or lowest priority first if a
+    priority function is given. Priorities only order the jobs waiting in the
+    queue, a job that arrives after a worker went idle starts right away. A
+    bounded queue only orders a window of max_pending jobs, so to order all
+    of them, queue them without a limit.
+    """
+
+    def __init__(self, download, workers=4, max_pending=1024, priority=None):
+        """ Creates a scheduler.
+
+        Args:
+            download: Function called with each job. A result of None counts
+                as a failed download.
+            workers: Number of worker threads.
+            max_pending: Number of jobs that can wait in the queue, 0 for no
+                limit.
+            priority: Optional: Function returning the priority of a job.
+        """
+        self._download = download
+        self._priority = priority
+        self._sequence = itertools.count()
+        self._queue = queue.PriorityQueue(maxsize=max_pending)
+        self._threads = [
+            threading.Thread(target=self._work, daemon=True)
+            for _ in range(max(1, workers))
+        ]
+        self._lock = threading.Lock()
+        self.completed = 0
+        self.failed = 0
+
+    def start(self):
+        """ Starts the worker threads. """
+        for thread in self._threads:
+            thread.start()
+
+    def put(self, job):
+        """ Queues a job, blocking while the queue is full.
+
+        Args:
+            job: The job passed on to the download function.
+        """
+        priority = self._priority(job) if self._priority else 0
+        # The sequence number keeps equal priorities in queue order.
+        self._queue.put((priority, next(self._sequence), job))
+
+    def join(self):
+        """ Waits for every queued job to finish and stops the workers. """
+        for _ in self._threads:
+            self._queue.put((float('inf'), next(self._sequence), None))
+        for thread in self._threads:
+            thread.join()
+
+    def _work(self):
+        """ Worker loop, downloads jobs until it receives None. """
+        while True:
+            job = self._queue.get()[2]
+            if job is None:
+                return
+            try:
+                result = self._download(job)
+            except Exception as error:  # pylint: disable=broad-except
+                print("Download of {} failed: {}".format(job, error),
+                      file=sys.stderr)
+                result = None
+            with self._lock:
+                if result is None:
+                    self.failed += 1
+                else:
+                    self.completed += 1
+
+
+def iter_concurrently(producers, max_pending=1024):
+    """ Runs producers on threads of their own and yields what they produce.
+
+    Args:
+        producers: Functions that are each called with a put function, which
+            they call with every item they produce.
+        max_pending: Number of produced items that can wait to be yielded.
+    Yields:
+        The produced items, in the order they are put.
+    Raises:
+        The first exception raised by a producer, once all producers are done.
+    """
+    items = queue.Queue(maxsize=max_pending)
+    done = object()
+    errors = []
+
+    def run(producer):
+        try:
+            producer(items.put)
+        except Exception as error:  # pylint: disable=broad-except
+            errors.append(error)
+        finally:
+            items.put(done)
+
+    threads = [
+        threading.Thread(target=run, args=(producer, ), daemon=True)
+        for producer in producers
+    ]
+    for thread in threads:
+        thread.start()
+    remaining = len(threads)
+    while remaining:
+        item = items.get()
+        if item is done:
+            remaining -= 1
+        else:
+            yield item
+    if errors:
+        raise errors[0]
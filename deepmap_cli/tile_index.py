@@ -0,0 +1,171 @@
+""" Deepmap CLI spatial index of downloaded tiles. """
+
+import os
+import re
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+from deepmap_cli.constants import INDEX_FILENAME
+from deepmap_cli.geo import lat_lng_to_tile, tile_bounds, quadkey
+
+# Matches the {format}_{id}_{x}_{y}_{z} names of downloaded tiles.
+TILE_NAME = re.compile(r'^([A-Za-z0-9]+)_(.+)_(\d+)_(\d+)_(\d+)\.(pb\.bin|tar\.gz|csv)$')
+
+# Tiles added between commits while downloading.
+COMMIT_EVERY = 256
+
+
+class TileIndex(object):
+    """ An on-disk index of the tiles downloaded into a folder.
+
+    The index is a sqlite database in the folder, keyed by the tile grid, so
+    point and bounding box lookups only touch the matching rows. It is safe
+    to add tiles from several download threads.
+    """
+
+    def __init__(self, folder, readonly=False):
+        """ Opens or creates the index of a folder.
+
+        Args:
+            folder: The folder tiles are downloaded into.
+            readonly: Whether to open an existing index for queries only,
+                instead of creating it if it is missing.
+        Raises:
+            sqlite3.OperationalError: If readonly is set and the folder has
+                no index.
+        """
+        self.folder = folder
+        self._lock = threading.Lock()
+        self._pending = 0
+        path = os.path.join(folder or '.', INDEX_FILENAME)
+        if readonly:
+            uri = 'file:{}?mode=ro'.format(
+                urllib.parse.quote(os.path.abspath(path)))
+            self._db = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            return
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS tiles ('
+                         'path TEXT PRIMARY KEY, map_id TEXT, format TEXT, '
+                         'x INTEGER, y INTEGER, z INTEGER, quadkey TEXT, '
+                         'min_lat REAL, min_lng REAL, max_lat REAL, max_lng REAL, '
+                         'release_timestamp TEXT, size INTEGER, written_at REAL)')
+        self._db.execute(
+            'CREATE INDEX IF NOT EXISTS tiles_grid ON tiles (z, x, y)')
+        self._db.commit()
+
+    def add(self, path, map_id, format, x, y, z, size, release_timestamp=None):
+        """ Records a downloaded tile, replacing any previous record of path.
+
+        Args:
+            path: Path of the tile file.
+            map_id: The id of the map.
+            format: The format of the tile.
+            x: The x offset of the tile.
+            y: The y offset of the tile.
+            z: The zoom level of the tile.
+            size: The size of the tile in bytes.
+            release_timestamp: Optional: The release timestamp of the tile.
+        """
+        x, y, z = int(x), int(y), int(z)
+        min_lat, min_lng, max_lat, max_lng = tile_bounds(x, y, z)
+        row = (os.path.basename(path), map_id, format, x, y, z,
+               quadkey(x, y, z), min_lat, min_lng, max_lat, max_lng,
+               release_timestamp, size, time.time())
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO tiles VALUES '
+                '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', row)
+            self._pending += 1
+            if self._pending >= COMMIT_EVERY:
+                self._db.commit()
+                self._pending = 0
+
+    def release_timestamp(self, path):
+        """ Returns the release timestamp recorded for a tile file, or None
+        if the tile is not indexed or its release is unknown.
+
+        Args:
+            path: Path of the tile file.
+        """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT release_timestamp FROM tiles WHERE path = ?',
+                (os.path.basename(path), )).fetchone()
+        return row[0] if row else None
+
+    def rebuild(self):
+        """ Re-creates the index from the names of the tiles in the folder.
+
+        Returns:
+            The number of tiles indexed.
+        """
+        with self._lock:
+            self._db.execute('DELETE FROM tiles')
+        count = 0
+        for name in os.listdir(self.folder or '.'):
+            match = TILE_NAME.match(name)
+            if match:
+                format, map_id, x, y, z = match.groups()[:5]
+                path = os.path.join(self.folder, name)
+                self.add(path, map_id, format, x, y, z, os.path.getsize(path))
+                count += 1
+        self.commit()
+        return count
+
+    def query(self, lat1, lng1, lat2=None, lng2=None, map_id=None, format=None):
+        """ Finds the tiles covering a point or intersecting a bounding box.
+
+        Args:
+            lat1: Latitude of the point, or of a corner of the box.
+            lng1: Longitude of the point, or of a corner of the box.
+            lat2: Optional: Latitude of the opposite corner of the box.
+            lng2: Optional: Longitude of the opposite corner of the box.
+            map_id: Optional: Only return tiles of this map.
+            format: Optional: Only return tiles of this format.
+        Returns:
+            A list of dicts describing the matching tiles, with their paths.
+        """
+        if lat2 is None:
+            lat2 = lat1
+        if lng2 is None:
+            lng2 = lng1
+        with self._lock:
+            levels = [
+                row[0] for row in self._db.execute('SELECT DISTINCT z FROM tiles')
+            ]
+            rows = []
+            for z in levels:
+                # Latitude grows towards the top of the grid, where y is 0.
+                x1, y1 = lat_lng_to_tile(max(lat1, lat2), min(lng1, lng2), z)
+                x2, y2 = lat_lng_to_tile(min(lat1, lat2), max(lng1, lng2), z)
+                sql = ('SELECT path, map_id, format, x, y, z, quadkey, '
+                       'release_timestamp, size FROM tiles WHERE z = ? AND '
+                       'x BETWEEN ? AND ? AND y BETWEEN ? AND ?')
+                params = [z, x1, x2, y1, y2]
+                if map_id is not None:
+                    sql += ' AND map_id = ?'
+                    params.append(map_id)
+                if format is not None:
+                    sql += ' AND format = ?'
+                    params.append(format)
+                rows.extend(self._db.execute(sql, params))
+
+        keys = ('path', 'map_id', 'format', 'x', 'y', 'z', 'quadkey',
+                'release_timestamp', 'size')
+        tiles = [dict(zip(keys, row)) for row in rows]
+        for tile in tiles:
+            tile['path'] = os.path.join(self.folder, tile['path'])
+        return tiles
+
+    def commit(self):
+        """ Writes the added tiles to disk. """
+        with self._lock:
+            self._db.commit()
+            self._pending = 0
+
+    def close(self):
+        """ Commits and closes the index. """
+        self.commit()
+        self._db.close()
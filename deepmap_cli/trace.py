@@ -0,0 +1,209 @@
+""" Deepmap CLI structured trace log. """
+
+import contextlib
+import json
+import os
+import queue
+import threading
+import time
+
+
+class Tracer(object):
+    """ Records spans of work into a JSON lines file.
+
+    Each line is one finished span with OpenTelemetry span fields: traceId,
+    spanId, parentSpanId, name, kind, startTimeUnixNano, endTimeUnixNano,
+    attributes and status. Every span of a run shares the trace id of the
+    command span.
+
+    Spans are handed to a background thread that serializes and writes them,
+    so recording a span costs the download threads no file I/O. Until start
+    is called, spans are not recorded at all.
+    """
+
+    def __init__(self):
+        self._queue = None
+        self._thread = None
+        self._trace_id = None
+        self._root = None
+        self._local = threading.local()
+
+    @property
+    def enabled(self):
+        """ True if spans are being recorded. """
+        return self._queue is not None
+
+    def start(self, path):
+        """ Starts recording spans, appending them to a file.
+
+        Args:
+            path: Path of the JSON lines file.
+        """
+        trace_file = open(path, mode='a')
+        self._trace_id = os.urandom(16).hex()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._write,
+                                        args=(trace_file, ),
+                                        daemon=True)
+        self._thread.start()
+        _instrument_requests(self)
+
+    def stop(self):
+        """ Writes out the recorded spans and stops recording. """
+        if self._queue is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._queue = None
+
+    @contextlib.contextmanager
+    def span(self, name, kind='INTERNAL', **attributes):
+        """ Records the work done in a with block as a span.
+
+        The span is the parent of spans started within the block on the same
+        thread. Spans started on other threads without a parent of their own
+        are children of the first span.
+
+        Args:
+            name: Name of the span.
+            kind: The OpenTelemetry span kind, e.g. INTERNAL or CLIENT.
+            attributes: Attributes of the span.
+        Yields:
+            The attributes of the span, which can be added to until the
+            block ends.
+        """
+        if self._queue is None:
+            yield attributes
+            return
+        stack = self._stack()
+        parent = stack[-1] if stack else self._root
+        record = {
+            'traceId': self._trace_id,
+            'spanId': os.urandom(8).hex(),
+            'parentSpanId': parent['spanId'] if parent else None,
+            'name': name,
+            'kind': kind,
+            'startTimeUnixNano': time.time_ns(),
+            'attributes': attributes,
+            'status': {
+                'code': 'OK'
+            },
+        }
+        if self._root is None:
+            self._root = record
+        stack.append(record)
+        try:
+            yield attributes
+        except SystemExit as exit:
+            # sys.exit with a message, e.g. for invalid arguments, exits with
+            # 1 and the message is kept with it. Only a zero code is a
+            # success.
+            code = exit.code
+            if isinstance(code, str):
+                attributes['process.exit.message'] = code
+                code = 1
+            attributes['process.exit.code'] = code or 0
+            if code:
+                record['status'] = {'code': 'ERROR', 'message': repr(exit)}
+            raise
+        except BaseException as error:
+            record['status'] = {'code': 'ERROR', 'message': repr(error)}
+            raise
+        finally:
+            stack.pop()
+            record['endTimeUnixNano'] = time.time_ns()
+            if self._queue is not None:
+                self._queue.put(record)
+
+    def record(self, name, start, end, kind='INTERNAL', error=None, **attributes):
+        """ Records a span that has already ended.
+
+        For work that is not a with block on a thread of its own, e.g. a
+        coroutine, whose spans cannot be nested through the thread's stack.
+        The span is a child of the first span.
+
+        Args:
+            name: Name of the span.
+            start: Start time of the span from time.time_ns.
+            end: End time of the span from time.time_ns.
+            kind: The OpenTelemetry span kind, e.g. INTERNAL or CLIENT.
+            error: Optional: The exception that ended the span.
+            attributes: Attributes of the span.
+        """
+        if self._queue is None:
+            return
+        status = {'code': 'OK'}
+        if error is not None:
+            status = {'code': 'ERROR', 'message': repr(error)}
+        self._queue.put({
+            'traceId': self._trace_id,
+            'spanId': os.urandom(8).hex(),
+            'parentSpanId': self._root['spanId'] if self._root else None,
+            'name': name,
+            'kind': kind,
+            'startTimeUnixNano': start,
+            'endTimeUnixNano': end,
+            'attributes': attributes,
+            'status': status,
+        })
+
+    def _stack(self):
+        """ Returns this thread's stack of open spans. """
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _write(self, trace_file):
+        """ Background loop writing spans until it receives None. """
+        with trace_file:
+            while True:
+                record = self._queue.get()
+                if record is None:
+                    return
+                trace_file.write(json.dumps(record, default=str) + '\n')
+                if self._queue.empty():
+                    trace_file.flush()
+
+
+def _instrument_requests(tracer):
+    """ Records a CLIENT span for every request sent with requests.
+
+    Like the OpenTelemetry instrumentation of requests, this wraps
+    Session.send. The span ends once the response headers arrive, the
+    transfer of a streamed body is part of the span of its file write.
+
+    Args:
+        tracer: The tracer recording the spans.
+    """
+    import requests
+
+    send = requests.Session.send
+    if getattr(send, 'traced', False):
+        return
+
+    def traced_send(session, request, **kwargs):
+        with tracer.span(request.method,
+                         kind='CLIENT',
+                         **{
+                             'http.request.method': request.method,
+                             'url.full': request.url,
+                         }) as attributes:
+            response = send(session, request, **kwargs)
+            attributes['http.response.status_code'] = response.status_code
+            length = response.headers.get('Content-Length')
+            attributes['http.response.content_length'] = (
+                int(length) if length and length.isdigit() else None)
+            # Redirects followed. These are not retries, which requests does
+            # not make by default.
+            attributes['http.redirect_count'] = len(response.history)
+            attributes['http.duration_ms'] = (
+                response.elapsed.total_seconds() * 1000)
+            return response
+
+    traced_send.traced = True
+    requests.Session.send = traced_send
+
+
+# The tracer of the CLI, started by --trace.
+tracer = Tracer()
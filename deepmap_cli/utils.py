@@ -1,5 +1,7 @@
 """ Deepmap CLI util functions. """
 
+import codecs
+import json
 import pprint
 import stat
 import sys
@@ -32,3 +34,69 @@ def print_formatted_json(data, fd=sys.stdout):
     """
     _pp = pprint.PrettyPrinter(width=80, compact=False, stream=fd)
     _pp.pprint(data)
+
+
+def iter_json_array(chunks):
+    """ Yields the elements of a json array as soon as each one is complete.
+
+    Args:
+        chunks: Iterable of bytes or str pieces of a json array, e.g. the
+            iter_content of a streamed response.
+    Yields:
+        The decoded elements of the array, in order.
+    Raises:
+        ValueError: If the text is not a json array.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
+    started = False
+    for chunk in chunks:
+        buf += utf8.decode(chunk) if isinstance(chunk, bytes) else chunk
+        pos = 0
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                if buf[pos] == ',' and not started:
+                    raise ValueError('Expected a json array.')
+                pos += 1
+            if pos == len(buf):
+                break
+            if not started:
+                if buf[pos] != '[':
+                    raise ValueError('Expected a json array.')
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == ']':
+                return
+            try:
+                element, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # The element is not complete yet, wait for more data.
+                break
+            if not isinstance(element, (dict, list)):
+                # A number or literal could continue in the next chunk, e.g.
+                # 1500.0 split after 1500, so it is only complete once the
+                # ',' or ']' after it has arrived.
+                after = end
+                while after < len(buf) and buf[after] in ' \t\r\n':
+                    after += 1
+                if after == len(buf) or buf[after] not in ',]':
+                    break
+            yield element
+            pos = end
+        buf = buf[pos:]
+    raise ValueError('Unterminated json array.')
+
+
+def peak_rss():
+    """ Returns the peak resident set size of the process in bytes, or None
+    where the platform does not report it.
+    """
+    try:
+        import resource  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak if sys.platform == 'darwin' else peak * 1024
@@ -0,0 +1,444 @@
+""" Deepmap CLI file writing. """
+
+import hashlib
+import os
+import re
+import shutil
+import stat
+import tempfile
+import threading
+
+from deepmap_cli.constants import DEFAULT_BUFFER_SIZE, BLOB_STORE_MARKER
+from deepmap_cli.trace import tracer
+
+# Layout of the blobs in a blob store: <2 hex digits>/<62 hex digits>.
+BLOB_DIR_PATTERN = re.compile(r'^[0-9a-f]{2}$')
+BLOB_NAME_PATTERN = re.compile(r'^[0-9a-f]{62}$')
+
+# The process umask once read by _umask, False before.
+_UMASK = False
+
+
+class TileWriter(object):
+    """ Writes downloaded files to disk.
+
+    Each file is streamed into a temp file next to its destination and renamed
+    over the destination once complete, so an interrupted download never
+    leaves a truncated file behind under the final name.
+
+    With an fsync batch size of n > 1, completed files are held back as temp
+    files and fsynced and renamed n at a time, with one fsync per directory
+    for the whole batch. Call flush once all files are written.
+
+    With a blob store, files are hashed while they are written and their
+    content is stored once in the store, named by its sha256. Each
+    destination is then a hard link to its blob, so identical files share
+    their disk space. Files are only ever replaced, never written in place,
+    so a shared blob cannot change under another link.
+    """
+
+    def __init__(self,
+                 buffer_size=DEFAULT_BUFFER_SIZE,
+                 fsync_batch=0,
+                 blob_store=None):
+        """ Creates a writer.
+
+        Args:
+            buffer_size: Size in bytes of the buffer each file is copied with.
+            fsync_batch: 0 to never fsync, otherwise the number of files that
+                are fsynced and renamed into place together.
+            blob_store: Optional: Folder of the content addressed store that
+                files are deduplicated through. It must be on the same
+                filesystem as the destinations, or files are copied out of
+                it instead of linked.
+        """
+        self._buffer_size = buffer_size
+        self._fsync_batch = fsync_batch
+        self._blob_store = blob_store
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = []
+        self._store_marked = False
+
+    def write(self, source, dest, content_length=None):
+        """ Copies a file-like object into dest.
+
+        Args:
+            source: Object with a readinto method, e.g. a response's raw.
+            dest: The path to write to.
+            content_length: Optional: Expected number of bytes. The file is
+                preallocated to this size, and a shorter source is an error.
+        Returns:
+            The number of bytes written.
+        Raises:
+            IOError: If the source ends before content_length bytes.
+        """
+        with tracer.span('write file', **{'file.path': dest}) as attributes:
+            written = self._write(source, dest, content_length)
+            attributes['file.size'] = written
+            return written
+
+    def _write(self, source, dest, content_length=None):
+        """ Writes dest through a temp file, without tracing. """
+        partial = self.begin(dest, content_length)
+        try:
+            buffer = self._buffer()
+            while True:
+                read = source.readinto(buffer)
+                if not read:
+                    break
+                partial.write(buffer[:read])
+        except BaseException:
+            partial.abort()
+            raise
+        return self.finish(partial)
+
+    def begin(self, dest, content_length=None):
+        """ Starts writing a file piece by piece, for sources that are not
+        file-like, e.g. asynchronous responses.
+
+        Args:
+            dest: The path to write to.
+            content_length: Optional: Expected number of bytes.
+        Returns:
+            A PartialFile to write the pieces to, and then pass to finish, or
+            to its abort method on failure.
+        """
+        digest = hashlib.sha256() if self._blob_store else None
+        return PartialFile(dest, content_length, digest)
+
+    def finish(self, partial):
+        """ Completes a file started with begin, like write does.
+
+        Args:
+            partial: The PartialFile returned by begin.
+        Returns:
+            The number of bytes written.
+        Raises:
+            IOError: If fewer than the expected number of bytes were written.
+        """
+        try:
+            partial.close(fsync=self._fsync_batch == 1)
+        except BaseException:
+            partial.abort()
+            raise
+
+        tmp, dest = partial.tmp, partial.dest
+        digest = partial.digest.hexdigest() if partial.digest else None
+        if self._fsync_batch == 0:
+            self._publish(tmp, dest, digest)
+        elif self._fsync_batch == 1:
+            for synced in self._publish(tmp, dest, digest):
+                _fsync_directory(synced)
+        else:
+            with self._lock:
+                self._pending.append((tmp, dest, digest))
+                full = len(self._pending) >= self._fsync_batch
+            if full:
+                self.flush()
+        return partial.written
+
+    def flush(self):
+        """ Fsyncs and renames into place every file held back for a batch. """
+        # Once flush returns, files a concurrent flush took over are in
+        # place as well.
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+            if not pending:
+                return
+            for tmp, _, _ in pending:
+                fd = os.open(tmp, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            directories = set()
+            for tmp, dest, digest in pending:
+                directories.update(self._publish(tmp, dest, digest))
+            for directory in directories:
+                _fsync_directory(directory)
+
+    def _publish(self, tmp, dest, digest):
+        """ Moves a complete temp file to its destination.
+
+        Args:
+            tmp: Path of the temp file.
+            dest: The destination path.
+            digest: The sha256 of the file if it goes through the blob store.
+        Returns:
+            The directories changed.
+        """
+        directory = os.path.dirname(dest) or '.'
+        if digest is None:
+            os.replace(tmp, dest)
+            return [directory]
+
+        if not self._store_marked:
+            mark_blob_store(self._blob_store)
+            self._store_marked = True
+        blob = blob_path(self._blob_store, digest)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        try:
+            # Linking fails if the blob exists, so concurrent writers of the
+            # same content agree on a single blob.
+            os.link(tmp, blob)
+        except FileExistsError:
+            os.remove(tmp)
+            tmp = _link_or_copy(blob, dest)
+        except OSError:
+            # No hard links here, keep a plain file.
+            os.replace(tmp, dest)
+            return [directory]
+        if os.path.exists(dest) and os.path.samefile(tmp, dest):
+            # Renaming a link over another link of the same file does nothing.
+            os.remove(tmp)
+        else:
+            os.replace(tmp, dest)
+        return [directory, os.path.dirname(blob)]
+
+    def _buffer(self):
+        """ Returns this thread's copy buffer. """
+        buffer = getattr(self._local, 'buffer', None)
+        if buffer is None:
+            buffer = self._local.buffer = memoryview(
+                bytearray(self._buffer_size))
+        return buffer
+
+
+def blob_path(blob_store, digest):
+    """ Returns the path of a blob in a blob store.
+
+    Args:
+        blob_store: Folder of the blob store.
+        digest: The hex sha256 of the content.
+    """
+    return os.path.join(blob_store, digest[:2], digest[2:])
+
+
+def mark_blob_store(blob_store):
+    """ Creates a blob store folder and the marker file that shows it is one.
+
+    Args:
+        blob_store: Folder of the blob store.
+    """
+    os.makedirs(blob_store, exist_ok=True)
+    marker = os.path.join(blob_store, BLOB_STORE_MARKER)
+    if not os.path.exists(marker):
+        with open(marker, mode='a'):
+            pass
+
+
+def is_blob_store(blob_store):
+    """ Returns True if a folder has the marker file of a blob store.
+
+    Args:
+        blob_store: Folder to check.
+    """
+    return os.path.isfile(os.path.join(blob_store, BLOB_STORE_MARKER))
+
+
+def collect_garbage(blob_store):
+    """ Removes the blobs that no downloaded file links to anymore.
+
+    A blob is only referenced through hard links, so a blob with a single
+    link is referenced by nothing but the store. Only files laid out like
+    blobs are considered, anything else in the folder is left alone.
+
+    Args:
+        blob_store: Folder of the blob store.
+    Returns:
+        The number of files removed and the bytes they freed.
+    Raises:
+        ValueError: The folder is not a blob store.
+    """
+    if not is_blob_store(blob_store):
+        raise ValueError("{} is not a blob store.".format(blob_store))
+    removed = 0
+    freed = 0
+    for prefix in os.listdir(blob_store):
+        directory = os.path.join(blob_store, prefix)
+        if not BLOB_DIR_PATTERN.match(prefix) or os.path.islink(
+                directory) or not os.path.isdir(directory):
+            continue
+        for name in os.listdir(directory):
+            if not BLOB_NAME_PATTERN.match(name):
+                continue
+            path = os.path.join(directory, name)
+            info = os.lstat(path)
+            if stat.S_ISREG(info.st_mode) and info.st_nlink == 1:
+                os.remove(path)
+                removed += 1
+                freed += info.st_size
+    return removed, freed
+
+
+def remove_partials(dests):
+    """ Removes the temp files left behind by interrupted writes of files,
+    e.g. when the process was killed.
+
+    Only call this while nothing is writing these files.
+
+    Args:
+        dests: The destination paths of the files.
+    Returns:
+        The number of temp files removed.
+    """
+    names = {}
+    for dest in dests:
+        directory, name = os.path.split(dest)
+        names.setdefault(directory or '.', set()).add(name)
+    removed = 0
+    for directory, dest_names in names.items():
+        if not os.path.isdir(directory):
+            continue
+        for entry in os.listdir(directory):
+            if not (entry.startswith('.') and entry.endswith('.part')):
+                continue
+            # Temp files are named .{name}.{random}.part
+            if entry[1:-len('.part')].rsplit('.', 1)[0] in dest_names:
+                os.remove(os.path.join(directory, entry))
+                removed += 1
+    return removed
+
+
+def _umask():
+    """ Returns the process umask, or None if it cannot be read.
+
+    os.umask can only read the umask by replacing it, which other threads
+    would see, so it is read from /proc instead, where Linux has it.
+    """
+    global _UMASK  # pylint: disable=global-statement
+    if _UMASK is False:
+        umask = None
+        try:
+            with open('/proc/self/status') as status:
+                for line in status:
+                    if line.startswith('Umask:'):
+                        umask = int(line.split()[1], 8)
+                        break
+        except (OSError, ValueError, IndexError):
+            pass
+        _UMASK = umask
+    return _UMASK
+
+
+def _link_or_copy(blob, dest):
+    """ Creates a new temp file next to dest with the content of a blob.
+
+    Args:
+        blob: Path of the blob.
+        dest: The destination path.
+    Returns:
+        The path of the temp file, a hard link to the blob if possible.
+    """
+    directory, name = os.path.split(dest)
+    fd, tmp = tempfile.mkstemp(prefix='.' + name + '.',
+                               suffix='.part',
+                               dir=directory or '.')
+    os.close(fd)
+    os.remove(tmp)
+    try:
+        os.link(blob, tmp)
+    except OSError:
+        shutil.copyfile(blob, tmp)
+    return tmp
+
+
+class PartialFile(object):
+    """ A file being written into its temp file by a TileWriter. """
+
+    def __init__(self, dest, content_length=None, digest=None):
+        """ Creates the temp file next to dest.
+
+        Args:
+            dest: The path the file is written to.
+            content_length: Optional: Expected number of bytes. The temp
+                file is preallocated to this size.
+            digest: Optional: A hashlib object updated with the written bytes.
+        """
+        directory, name = os.path.split(dest)
+        fd, self.tmp = tempfile.mkstemp(prefix='.' + name + '.',
+                                        suffix='.part',
+                                        dir=directory or '.')
+        self.dest = dest
+        self.content_length = content_length
+        self.digest = digest
+        self.written = 0
+        self._file = os.fdopen(fd, 'wb', buffering=0)
+        umask = _umask()
+        if umask is not None and hasattr(os, 'fchmod'):
+            # mkstemp creates files readable by their owner only, published
+            # files get the mode of any other new file instead. Without the
+            # umask they keep the mode of mkstemp.
+            os.fchmod(fd, 0o666 & ~umask)
+        if content_length:
+            _preallocate(fd, content_length)
+
+    def write(self, chunk):
+        """ Appends bytes to the file.
+
+        Args:
+            chunk: A bytes-like object.
+        """
+        if self.digest is not None:
+            self.digest.update(chunk)
+        view = memoryview(chunk)
+        while view:
+            view = view[self._file.write(view):]
+        self.written += len(chunk)
+
+    def close(self, fsync=False):
+        """ Closes the complete temp file.
+
+        Args:
+            fsync: Whether to fsync the file before closing it.
+        Raises:
+            IOError: If fewer than content_length bytes were written.
+        """
+        if self.content_length and self.written < self.content_length:
+            raise IOError('Expected {} bytes for {}, received {}.'.format(
+                self.content_length, self.dest, self.written))
+        if fsync:
+            os.fsync(self._file.fileno())
+        self._file.close()
+
+    def abort(self):
+        """ Closes and removes the temp file. """
+        self._file.close()
+        if os.path.exists(self.tmp):
+            os.remove(self.tmp)
+
+
+def _preallocate(fd, size):
+    """ Reserves disk space for a file where the platform supports it.
+
+    Args:
+        fd: File descriptor of the file.
+        size: Number of bytes to reserve.
+    """
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError:
+            # Not supported by every filesystem, the write works regardless.
+            pass
+
+
+def _fsync_directory(directory):
+    """ Fsyncs a directory so renames within it are durable.
+
+    Args:
+        directory: Path of the directory.
+    """
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
@@ -10,6 +10,14 @@ INSTALL_REQUIRES = [
     'typed-ast==1.4.3', 'urllib3==1.25.4', 'wrapt==1.11.1'
 ]
 
+# Optional dependencies of pose conversion, e.g. 'pip install .[parquet]',
+# and of the async download engine.
+EXTRAS_REQUIRE = {
+    'npy': ['numpy'],
+    'parquet': ['numpy', 'pyarrow'],
+    'async': ['aiohttp']
+}
+
 setup(name='deepmap_cli',
       version='1.0',
       description='The Deepmap API Command Line Interface.',
@@ -24,4 +32,5 @@ setup(name='deepmap_cli',
       licence='',
       packages=find_packages(),
       install_requires=INSTALL_REQUIRES,
+      extras_require=EXTRAS_REQUIRE,
       entry_points={'console_scripts': ['deepmap = deepmap_cli:run']})
@@ -0,0 +1,57 @@
+""" Tests of the Deepmap CLI web mercator tile math. """
+
+import unittest
+
+from deepmap_cli.geo import hilbert_index, lat_lng_to_tile, tile_bounds
+
+
+class HilbertIndexTest(unittest.TestCase):
+    """ Tests of hilbert_index. """
+
+    def test_covers_the_grid_once(self):
+        for z in range(6):
+            size = 1 << z
+            indexes = sorted(
+                hilbert_index(x, y, z) for x in range(size)
+                for y in range(size))
+            self.assertEqual(indexes, list(range(size * size)), z)
+
+    def test_consecutive_tiles_are_neighbours(self):
+        for z in range(1, 6):
+            size = 1 << z
+            tiles = sorted(((x, y) for x in range(size) for y in range(size)),
+                           key=lambda tile, z=z: hilbert_index(*tile, z))
+            for (x1, y1), (x2, y2) in zip(tiles, tiles[1:]):
+                self.assertEqual(abs(x1 - x2) + abs(y1 - y2), 1,
+                                 (z, x1, y1, x2, y2))
+
+    def test_first_level(self):
+        self.assertEqual([
+            hilbert_index(x, y, 1) for x, y in ((0, 0), (0, 1), (1, 1),
+                                                (1, 0))
+        ], [0, 1, 2, 3])
+
+    def test_starts_and_ends_in_corners(self):
+        for z in range(1, 6):
+            size = 1 << z
+            self.assertEqual(hilbert_index(0, 0, z), 0)
+            self.assertEqual(hilbert_index(size - 1, 0, z), size * size - 1)
+
+
+class TileMathTest(unittest.TestCase):
+    """ Tests of lat_lng_to_tile and tile_bounds. """
+
+    def test_tile_contains_its_positions(self):
+        for lat, lng, z in ((37.77, -122.42, 14), (-33.86, 151.2, 10),
+                            (0.5, 0.5, 3)):
+            x, y = lat_lng_to_tile(lat, lng, z)
+            min_lat, min_lng, max_lat, max_lng = tile_bounds(x, y, z)
+            self.assertTrue(min_lat <= lat <= max_lat)
+            self.assertTrue(min_lng <= lng <= max_lng)
+
+    def test_origin_is_top_left(self):
+        self.assertEqual(lat_lng_to_tile(85.0, -179.9, 4), (0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+""" Tests of the Deepmap CLI journal of bulk download jobs. """
+
+import argparse
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+from deepmap_cli.journal import JobJournal
+
+
+def tile_job(x, map_id='m1', format='GeoJsonTile'):
+    """ Returns the download job of a tile. """
+    return (map_id, format, {'x': x, 'y': 0, 'z': 14, 'release_timestamp': 1})
+
+
+class JobJournalTest(unittest.TestCase):
+    """ Tests of JobJournal. """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'jobs', 'jobs.sqlite')
+        self.journal = JobJournal(self.path)
+        self.args = argparse.Namespace(id='m1', token='secret', z=14)
+        self.job_id = self.journal.create(self.args,
+                                          [('m1', 'GeoJsonTile')])
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.folder)
+
+    def committed_states(self):
+        """ Returns the committed state of each tile, as another process
+        reading the journal sees it.
+        """
+        db = sqlite3.connect(self.path)
+        try:
+            return dict(db.execute('SELECT x, state FROM tiles'))
+        finally:
+            db.close()
+
+    def test_create(self):
+        job = self.journal.get(self.job_id)
+        self.assertEqual(job['state'], 'running')
+        self.assertEqual(job['args'], {'id': 'm1', 'z': 14})
+        self.assertIsNone(self.journal.get(self.job_id + 1))
+
+    def test_plan_skips_done_tiles(self):
+        self.assertTrue(self.journal.plan(self.job_id, tile_job(1)))
+        self.assertTrue(self.journal.plan(self.job_id, tile_job(1)))
+        self.journal.set_tile(self.job_id, tile_job(1), 'done')
+        self.journal.commit()
+        self.assertFalse(self.journal.plan(self.job_id, tile_job(1)))
+
+    def test_pending_and_done(self):
+        for x in range(3):
+            self.journal.plan(self.job_id, tile_job(x))
+        self.journal.set_tile(self.job_id, tile_job(0), 'in_flight')
+        self.journal.set_tile(self.job_id, tile_job(1), 'done')
+        self.journal.commit()
+        self.assertEqual(
+            self.journal.pending(self.job_id, 'm1', 'GeoJsonTile'),
+            [tile_job(0), tile_job(2)])
+        self.assertEqual(self.journal.done(self.job_id), [tile_job(1)])
+        tiles = self.journal.jobs()[0]['tiles']
+        self.assertEqual(tiles, {'planned': 1, 'in_flight': 1, 'done': 1})
+
+    def test_end_incomplete_until_searched_and_done(self):
+        self.journal.plan(self.job_id, tile_job(0))
+        self.journal.set_tile(self.job_id, tile_job(0), 'done')
+        self.assertEqual(self.journal.end(self.job_id), 'incomplete')
+        self.assertFalse(
+            self.journal.searched(self.job_id, 'm1', 'GeoJsonTile'))
+        self.journal.finish_search(self.job_id, 'm1', 'GeoJsonTile')
+        self.assertTrue(
+            self.journal.searched(self.job_id, 'm1', 'GeoJsonTile'))
+        self.journal.plan(self.job_id, tile_job(1))
+        self.assertEqual(self.journal.end(self.job_id), 'incomplete')
+        self.journal.set_tile(self.job_id, tile_job(1), 'done')
+        self.assertEqual(self.journal.end(self.job_id), 'completed')
+        job = self.journal.jobs()[0]
+        self.assertEqual(job['tiles']['done'], 2)
+        self.assertEqual(self.committed_states(), {})
+
+    def test_cancel(self):
+        self.journal.plan(self.job_id, tile_job(0))
+        self.journal.cancel(self.job_id)
+        self.assertEqual(self.journal.get(self.job_id)['state'], 'cancelled')
+        self.assertEqual(
+            self.journal.pending(self.job_id, 'm1', 'GeoJsonTile'), [])
+
+    def test_done_is_committed_after_before_commit(self):
+        flushed = []
+
+        def before_commit():
+            # Nothing marked done is on disk before the flush.
+            flushed.append(self.committed_states())
+
+        journal = JobJournal(self.path, before_commit=before_commit)
+        try:
+            journal.plan(self.job_id, tile_job(0))
+            journal.set_tile(self.job_id, tile_job(0), 'done')
+            journal.commit()
+        finally:
+            journal.close()
+        self.assertNotIn('done', flushed[0].values())
+        self.assertEqual(self.committed_states(), {0: 'done'})
+
+    def test_tiles_done_during_before_commit_wait_for_the_next_commit(self):
+        journal = None
+
+        def before_commit():
+            # A download finishing while the writer flushes, on another
+            # thread, must not wait for the flush.
+            thread = threading.Thread(target=journal.set_tile,
+                                      args=(self.job_id, tile_job(1),
+                                            'done'))
+            thread.start()
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+
+        journal = JobJournal(self.path)
+        try:
+            journal.plan(self.job_id, tile_job(0))
+            journal.plan(self.job_id, tile_job(1))
+            journal.set_tile(self.job_id, tile_job(0), 'done')
+            journal._before_commit = before_commit  # pylint: disable=protected-access
+            journal.commit()
+            self.assertEqual(self.committed_states(), {
+                0: 'done',
+                1: 'planned'
+            })
+            journal._before_commit = None  # pylint: disable=protected-access
+            journal.commit()
+            self.assertEqual(self.committed_states(), {0: 'done', 1: 'done'})
+        finally:
+            journal.close()
+
+    def test_failed_before_commit_keeps_the_tiles(self):
+
+        def before_commit():
+            raise OSError('disk full')
+
+        journal = JobJournal(self.path, before_commit=before_commit)
+        journal.plan(self.job_id, tile_job(0))
+        journal.set_tile(self.job_id, tile_job(0), 'done')
+        with self.assertRaises(OSError):
+            journal.commit()
+        journal._before_commit = None  # pylint: disable=protected-access
+        journal.close()
+        self.assertEqual(self.committed_states(), {0: 'done'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+""" Tests of the Deepmap CLI clipping of GeoJSON geometries. """
+
+import unittest
+
+from deepmap_cli.merge import clip_geometry
+
+BBOX = (0.0, 0.0, 10.0, 10.0)
+
+
+def area(ring):
+    """ Returns the area of a closed ring with the shoelace formula. """
+    return abs(
+        sum(a[0] * b[1] - b[0] * a[1] for a, b in zip(ring, ring[1:]))) / 2
+
+
+class ClipGeometryTest(unittest.TestCase):
+    """ Tests of clip_geometry. """
+
+    def test_point(self):
+        point = {'type': 'Point', 'coordinates': [5.0, 5.0]}
+        self.assertEqual(clip_geometry(point, BBOX), point)
+        self.assertIsNone(
+            clip_geometry({
+                'type': 'Point',
+                'coordinates': [11.0, 5.0]
+            }, BBOX))
+
+    def test_point_on_the_edge_is_inside(self):
+        point = {'type': 'Point', 'coordinates': [10.0, 0.0]}
+        self.assertEqual(clip_geometry(point, BBOX), point)
+
+    def test_multi_point(self):
+        clipped = clip_geometry(
+            {
+                'type': 'MultiPoint',
+                'coordinates': [[1.0, 1.0], [-1.0, 1.0], [2.0, 2.0]]
+            }, BBOX)
+        self.assertEqual(clipped, {
+            'type': 'MultiPoint',
+            'coordinates': [[1.0, 1.0], [2.0, 2.0]]
+        })
+
+    def test_line_inside_is_unchanged(self):
+        line = {'type': 'LineString', 'coordinates': [[1.0, 1.0], [9.0, 9.0]]}
+        self.assertEqual(clip_geometry(line, BBOX), line)
+
+    def test_line_is_cut_at_the_edges(self):
+        clipped = clip_geometry(
+            {
+                'type': 'LineString',
+                'coordinates': [[-5.0, 5.0], [5.0, 5.0], [15.0, 5.0]]
+            }, BBOX)
+        self.assertEqual(clipped, {
+            'type': 'LineString',
+            'coordinates': [[0.0, 5.0], [5.0, 5.0], [10.0, 5.0]]
+        })
+
+    def test_line_leaving_and_entering_is_split(self):
+        clipped = clip_geometry(
+            {
+                'type': 'LineString',
+                'coordinates': [[5.0, 5.0], [5.0, 15.0], [8.0, 15.0],
+                                [8.0, 5.0]]
+            }, BBOX)
+        self.assertEqual(clipped, {
+            'type': 'MultiLineString',
+            'coordinates': [[[5.0, 5.0], [5.0, 10.0]],
+                            [[8.0, 10.0], [8.0, 5.0]]]
+        })
+
+    def test_line_outside(self):
+        self.assertIsNone(
+            clip_geometry(
+                {
+                    'type': 'LineString',
+                    'coordinates': [[11.0, 0.0], [11.0, 10.0]]
+                }, BBOX))
+
+    def test_polygon_inside_is_unchanged(self):
+        ring = [[1.0, 1.0], [4.0, 1.0], [4.0, 4.0], [1.0, 4.0], [1.0, 1.0]]
+        clipped = clip_geometry({'type': 'Polygon', 'coordinates': [ring]},
+                                BBOX)
+        self.assertEqual(clipped['type'], 'Polygon')
+        self.assertEqual(clipped['coordinates'], [ring])
+
+    def test_polygon_is_clipped_to_the_box(self):
+        ring = [[5.0, 5.0], [15.0, 5.0], [15.0, 15.0], [5.0, 15.0],
+                [5.0, 5.0]]
+        clipped = clip_geometry({'type': 'Polygon', 'coordinates': [ring]},
+                                BBOX)
+        exterior = clipped['coordinates'][0]
+        self.assertEqual(exterior[0], exterior[-1])
+        self.assertAlmostEqual(area(exterior), 25.0)
+        for lng, lat in exterior:
+            self.assertTrue(5.0 <= lng <= 10.0 and 5.0 <= lat <= 10.0)
+
+    def test_box_inside_polygon(self):
+        ring = [[-5.0, -5.0], [15.0, -5.0], [15.0, 15.0], [-5.0, 15.0],
+                [-5.0, -5.0]]
+        clipped = clip_geometry({'type': 'Polygon', 'coordinates': [ring]},
+                                BBOX)
+        self.assertAlmostEqual(area(clipped['coordinates'][0]), 100.0)
+
+    def test_hole_outside_the_box_is_dropped(self):
+        exterior = [[5.0, 5.0], [25.0, 5.0], [25.0, 9.0], [5.0, 9.0],
+                    [5.0, 5.0]]
+        hole = [[20.0, 6.0], [21.0, 6.0], [21.0, 7.0], [20.0, 6.0]]
+        clipped = clip_geometry(
+            {
+                'type': 'Polygon',
+                'coordinates': [exterior, hole]
+            }, BBOX)
+        self.assertEqual(len(clipped['coordinates']), 1)
+
+    def test_polygon_outside(self):
+        ring = [[20.0, 20.0], [30.0, 20.0], [30.0, 30.0], [20.0, 20.0]]
+        self.assertIsNone(
+            clip_geometry({
+                'type': 'Polygon',
+                'coordinates': [ring]
+            }, BBOX))
+
+    def test_multi_polygon_keeps_the_parts_inside(self):
+        inside = [[1.0, 1.0], [2.0, 1.0], [2.0, 2.0], [1.0, 1.0]]
+        outside = [[20.0, 20.0], [30.0, 20.0], [30.0, 30.0], [20.0, 20.0]]
+        clipped = clip_geometry(
+            {
+                'type': 'MultiPolygon',
+                'coordinates': [[inside], [outside]]
+            }, BBOX)
+        self.assertEqual(clipped, {'type': 'Polygon', 'coordinates': [inside]})
+
+    def test_geometry_collection(self):
+        clipped = clip_geometry(
+            {
+                'type':
+                'GeometryCollection',
+                'geometries': [{
+                    'type': 'Point',
+                    'coordinates': [1.0, 1.0]
+                }, {
+                    'type': 'Point',
+                    'coordinates': [20.0, 1.0]
+                }]
+            }, BBOX)
+        self.assertEqual(
+            clipped, {
+                'type': 'GeometryCollection',
+                'geometries': [{
+                    'type': 'Point',
+                    'coordinates': [1.0, 1.0]
+                }]
+            })
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+""" Tests of the Deepmap CLI download scheduling. """
+
+import threading
+import unittest
+
+from deepmap_cli.scheduler import DownloadScheduler
+
+
+class DownloadSchedulerTest(unittest.TestCase):
+    """ Tests of DownloadScheduler. """
+
+    def test_unbounded_queue_orders_every_waiting_job(self):
+        started = threading.Event()
+        release = threading.Event()
+        order = []
+
+        def download(job):
+            if not started.is_set():
+                started.set()
+                release.wait(5)
+            order.append(job)
+            return job
+
+        scheduler = DownloadScheduler(download,
+                                      workers=1,
+                                      max_pending=0,
+                                      priority=lambda job: -job)
+        scheduler.start()
+        scheduler.put(0)
+        started.wait(5)
+        # More jobs than the default window wait while the worker is busy.
+        for job in range(1, 3000):
+            scheduler.put(job)
+        release.set()
+        scheduler.join()
+        self.assertEqual(order, [0] + list(range(2999, 0, -1)))
+        self.assertEqual(scheduler.completed, 3000)
+
+    def test_failures_are_counted(self):
+
+        def download(job):
+            if job == 1:
+                raise IOError('failed')
+            return None if job == 2 else job
+
+        scheduler = DownloadScheduler(download, workers=2)
+        scheduler.start()
+        for job in range(4):
+            scheduler.put(job)
+        scheduler.join()
+        self.assertEqual((scheduler.completed, scheduler.failed), (2, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+""" Tests of the Deepmap CLI util functions. """
+
+import unittest
+
+from deepmap_cli.utils import iter_json_array
+
+ARRAY = (b'[1500.0, -2e-3, 7, true, false, null, "a, \\"b\\" ]", '
+         b'{"id": 1, "tiles": [1, 2]}, [3, [4]], 42]')
+ELEMENTS = [
+    1500.0, -2e-3, 7, True, False, None, 'a, "b" ]', {
+        'id': 1,
+        'tiles': [1, 2]
+    }, [3, [4]], 42
+]
+
+
+def split(data, size):
+    """ Returns data in pieces of size bytes. """
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class IterJsonArrayTest(unittest.TestCase):
+    """ Tests of iter_json_array. """
+
+    def test_whole(self):
+        self.assertEqual(list(iter_json_array([ARRAY])), ELEMENTS)
+
+    def test_every_chunk_size(self):
+        for size in range(1, len(ARRAY) + 1):
+            self.assertEqual(list(iter_json_array(split(ARRAY, size))),
+                             ELEMENTS, size)
+
+    def test_every_split_point(self):
+        for point in range(1, len(ARRAY)):
+            chunks = [ARRAY[:point], ARRAY[point:]]
+            self.assertEqual(list(iter_json_array(chunks)), ELEMENTS, point)
+
+    def test_number_split_in_its_fraction_and_exponent(self):
+        self.assertEqual(list(iter_json_array(split(b'[1500.0]', 1))),
+                         [1500.0])
+        self.assertEqual(list(iter_json_array([b'[1', b'5e', b'2', b']'])),
+                         [1500.0])
+
+    def test_multibyte_character_split(self):
+        data = '["café", "地図"]'.encode('utf-8')
+        self.assertEqual(list(iter_json_array(split(data, 1))),
+                         ['café', '地図'])
+
+    def test_str_chunks(self):
+        self.assertEqual(list(iter_json_array(['[1, ', '2', ']'])), [1, 2])
+
+    def test_whitespace(self):
+        self.assertEqual(list(iter_json_array([b' \n[ 1 ,\t2 \r\n] '])),
+                         [1, 2])
+
+    def test_empty(self):
+        self.assertEqual(list(iter_json_array([b'[]'])), [])
+        self.assertEqual(list(iter_json_array(split(b' [ ] ', 1))), [])
+
+    def test_elements_arrive_before_the_end(self):
+        elements = iter_json_array(iter([b'[{"a": 1}, {"b"', b': 2}']))
+        self.assertEqual(next(elements), {'a': 1})
+        self.assertEqual(next(elements), {'b': 2})
+
+    def test_not_an_array(self):
+        with self.assertRaises(ValueError):
+            list(iter_json_array([b'{"a": 1}']))
+        with self.assertRaises(ValueError):
+            list(iter_json_array([b',[1]']))
+
+    def test_unterminated(self):
+        with self.assertRaises(ValueError):
+            list(iter_json_array([b'[1, 2']))
+        with self.assertRaises(ValueError):
+            list(iter_json_array([b'[{"a": 1}']))
+        with self.assertRaises(ValueError):
+            list(iter_json_array([]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+""" Tests of the Deepmap CLI file writer and blob store. """
+
+import hashlib
+import io
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+from unittest import mock
+
+from deepmap_cli.constants import BLOB_STORE_MARKER
+from deepmap_cli.writer import TileWriter, blob_path, collect_garbage, \
+    mark_blob_store
+
+
+class BlobStoreTest(unittest.TestCase):
+    """ Tests of writing through a blob store and collecting its garbage. """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.store = os.path.join(self.folder, '.deepmap_blobs')
+        self.writer = TileWriter(blob_store=self.store)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write(self, name, content):
+        """ Writes a file of the folder through the writer. """
+        path = os.path.join(self.folder, name)
+        self.writer.write(io.BytesIO(content), path, len(content))
+        return path
+
+    def blobs(self):
+        """ Returns the paths of the blobs in the store. """
+        return sorted(
+            os.path.join(directory, name)
+            for directory, _, names in os.walk(self.store) for name in names
+            if name != BLOB_STORE_MARKER)
+
+    def test_identical_files_share_one_inode(self):
+        first = self.write('a.tar.gz', b'tile')
+        second = self.write('b.tar.gz', b'tile')
+        self.assertTrue(os.path.samefile(first, second))
+        digest = hashlib.sha256(b'tile').hexdigest()
+        self.assertEqual(self.blobs(), [blob_path(self.store, digest)])
+        self.assertEqual(os.stat(first).st_nlink, 3)
+
+    def test_rewriting_a_file_keeps_a_single_blob(self):
+        path = self.write('a.tar.gz', b'tile')
+        self.write('a.tar.gz', b'tile')
+        with open(path, 'rb') as tile:
+            self.assertEqual(tile.read(), b'tile')
+        self.assertEqual(len(self.blobs()), 1)
+        self.assertEqual(os.stat(path).st_nlink, 2)
+        self.assertEqual(
+            [name for name in os.listdir(self.folder) if '.part' in name],
+            [])
+
+    def test_writing_marks_the_store(self):
+        self.write('a.tar.gz', b'tile')
+        self.assertTrue(
+            os.path.isfile(os.path.join(self.store, BLOB_STORE_MARKER)))
+
+    def test_gc_refuses_a_folder_without_the_marker(self):
+        tile = os.path.join(self.folder, 'GeoJsonTile_m1_1_2_3.tar.gz')
+        with open(tile, 'wb') as tile_file:
+            tile_file.write(b'tile')
+        with self.assertRaises(ValueError):
+            collect_garbage(self.folder)
+        self.assertTrue(os.path.exists(tile))
+
+    def test_gc_removes_only_unlinked_blobs(self):
+        kept = self.write('a.tar.gz', b'kept')
+        os.remove(self.write('b.tar.gz', b'removed'))
+        self.assertEqual(collect_garbage(self.store), (1, len(b'removed')))
+        digest = hashlib.sha256(b'kept').hexdigest()
+        self.assertEqual(self.blobs(), [blob_path(self.store, digest)])
+        self.assertTrue(os.path.exists(kept))
+
+    def test_gc_skips_files_outside_the_blob_layout(self):
+        mark_blob_store(self.store)
+        digest = hashlib.sha256(b'blob').hexdigest()
+        strays = [
+            os.path.join(self.store, 'notes.txt'),
+            os.path.join(self.store, digest[:2], 'notes.txt'),
+            os.path.join(self.store, digest[:2], digest[2:].upper()),
+            os.path.join(self.store, 'zz', digest[2:]),
+            os.path.join(self.store, digest[:2], 'sub', digest[2:]),
+        ]
+        for stray in strays:
+            os.makedirs(os.path.dirname(stray), exist_ok=True)
+            with open(stray, 'wb') as stray_file:
+                stray_file.write(b'stray')
+        blob = blob_path(self.store, digest)
+        with open(blob, 'wb') as blob_file:
+            blob_file.write(b'blob')
+        self.assertEqual(collect_garbage(self.store), (1, len(b'blob')))
+        self.assertFalse(os.path.exists(blob))
+        for stray in strays:
+            self.assertTrue(os.path.exists(stray), stray)
+
+
+class TileWriterTest(unittest.TestCase):
+    """ Tests of writing files without a blob store. """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_batched_files_appear_on_flush(self):
+        writer = TileWriter(fsync_batch=3)
+        path = os.path.join(self.folder, 'a.tar.gz')
+        writer.write(io.BytesIO(b'tile'), path)
+        self.assertFalse(os.path.exists(path))
+        writer.flush()
+        with open(path, 'rb') as tile:
+            self.assertEqual(tile.read(), b'tile')
+        self.assertEqual(os.listdir(self.folder), ['a.tar.gz'])
+
+    def test_files_get_the_mode_of_new_files(self):
+        umask = os.umask(0o027)
+        try:
+            with mock.patch('deepmap_cli.writer._UMASK', False):
+                path = os.path.join(self.folder, 'a.tar.gz')
+                TileWriter().write(io.BytesIO(b'tile'), path)
+        finally:
+            os.umask(umask)
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o640)
+
+    def test_short_source_is_an_error(self):
+        writer = TileWriter()
+        path = os.path.join(self.folder, 'a.tar.gz')
+        with self.assertRaises(IOError):
+            writer.write(io.BytesIO(b'til'), path, 4)
+        self.assertEqual(os.listdir(self.folder), [])
+
+
+if __name__ == '__main__':
+    unittest.main()